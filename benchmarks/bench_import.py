@@ -0,0 +1,39 @@
+import os
+import sys
+import argparse
+import statistics
+import subprocess
+
+# cold-start import time of toorpia.utils (interactive) vs toorpia.headless (batch workers).
+# every sample runs in a fresh interpreter, as a forked short-lived worker would.
+#   python benchmarks/bench_import.py -n 20
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def measure(module, env):
+    code = f"import time; t = time.perf_counter(); import {module}; print(time.perf_counter() - t)"
+    rv = subprocess.run([sys.executable, '-c', code], env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    if rv.returncode != 0:
+        return None
+    return float(rv.stdout.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description='measure cold-start import time of toorpia modules')
+    parser.add_argument('-n', '--repeat', type=int, default=10, help='number of fresh interpreters per module')
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = REPO_DIR + os.pathsep + env.get('PYTHONPATH', '')
+    env.pop('TOORPIA_HEADLESS', None)
+
+    print('%-18s %10s %10s %10s' % ('module', 'median[ms]', 'min[ms]', 'max[ms]'))
+    for module in ['numpy', 'toorpia.utils', 'toorpia.headless']:
+        samples = [measure(module, env) for _ in range(args.repeat)]
+        if None in samples:
+            print('%-18s %10s' % (module, 'failed'))
+            continue
+        samples = [t * 1000 for t in samples]
+        print('%-18s %10.1f %10.1f %10.1f' % (module, statistics.median(samples), min(samples), max(samples)))
+
+if __name__ == '__main__':
+    main()
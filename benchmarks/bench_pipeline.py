@@ -0,0 +1,256 @@
+import os
+import sys
+import json
+import time
+import wave
+import shutil
+import argparse
+import resource
+import tempfile
+import statistics
+import subprocess
+import numpy
+
+# throughput and memory of create_basemap / open_basemap / addplot and of the remote toolkit on synthetic data.
+# mkcsvseg, mkfftseg, filter and toorpia are replaced by the stand-ins in benchmarks/stubs when they are not
+# installed (or always with --stubs always), so the figures then cover the Python orchestration and I/O only.
+# the remote toolkit runs over a local transport (benchmarks/stubs/ssh executes the "remote" command here).
+# every measurement runs in a fresh interpreter, so peak RSS is per operation.
+#   python benchmarks/bench_pipeline.py --sizes 4 16 --reduce-factors 1 10 --window-lengths 1024 4096
+#   python benchmarks/bench_pipeline.py --save baseline.json
+#   python benchmarks/bench_pipeline.py --baseline baseline.json --tolerance 0.2   # exit status 1 on regression
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STUB_DIR = os.path.join(REPO_DIR, 'benchmarks', 'stubs')
+BINARIES = ['mkcsvseg', 'mkfftseg', 'toorpia']
+FILTER_CMD = '/usr/local/bin/filter'
+SAMPLING_RATE = 48000
+
+def make_bin_dir(bin_dir, stubs):
+    # link the real binaries if they are installed, otherwise the stand-ins. returns {name: path, 'stubs': [names]}
+    binaries = {'stubs': []}
+    for name in BINARIES + ['filter']:
+        real = FILTER_CMD if name == 'filter' else shutil.which(name)
+        if stubs == 'always' or real is None or not os.access(real, os.X_OK):
+            real = os.path.join(STUB_DIR, name)
+            binaries['stubs'].append(name)
+        os.symlink(real, os.path.join(bin_dir, name))
+        binaries[name] = os.path.join(bin_dir, name)
+    os.symlink(os.path.join(STUB_DIR, 'ssh'), os.path.join(bin_dir, 'ssh'))
+    return binaries
+
+def make_table_csv(path, size_mib, n_cols, seed):
+    # random walks with noise, about size_mib MiB of text
+    rng = numpy.random.default_rng(seed)
+    n_rows = max(int(size_mib * 1024 ** 2 / (n_cols * 9)), 1)
+    level = numpy.zeros(n_cols)
+    with open(path, 'w') as f:
+        f.write(','.join('c%d' % (i + 1) for i in range(n_cols)) + '\n')
+        for start in range(0, n_rows, 65536):
+            steps = rng.standard_normal((min(65536, n_rows - start), n_cols)) * 0.1
+            block = level + numpy.cumsum(steps, axis=0)
+            level = block[-1]
+            numpy.savetxt(f, block + rng.standard_normal(block.shape) * 0.01, fmt='%.4f', delimiter=',')
+    return n_rows
+
+def make_wav(path, size_mib, seed):
+    # 16 bit mono: a few drifting tones with noise, about size_mib MiB
+    rng = numpy.random.default_rng(seed)
+    n_samples = max(int(size_mib * 1024 ** 2 / 2), 1)
+    with wave.open(path, 'wb') as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(SAMPLING_RATE)
+        for start in range(0, n_samples, SAMPLING_RATE * 10):
+            t = numpy.arange(start, min(start + SAMPLING_RATE * 10, n_samples)) / SAMPLING_RATE
+            signal = sum(numpy.sin(2 * numpy.pi * f * (1 + 0.01 * numpy.sin(t)) * t) for f in (440, 3000, 9000)) / 4
+            signal += rng.standard_normal(t.shape) * 0.05
+            w.writeframes((numpy.clip(signal, -1, 1) * 32767).astype('<i2').tobytes())
+    return n_samples
+
+def run_local(case):
+    import toorpia.utils as utils
+    utils.FILTER_CMD = case['filter_cmd']
+    stages = []
+    options = dict(case['options'], profile=True, profile_hook=stages.append)
+    result = getattr(utils, case['op'])(options)
+    return len(result[0]), stages
+
+def run_remote(case):
+    sys.path.insert(0, os.path.join(REPO_DIR, 'remote'))
+    from remote_utils import toorpia_remote_toolkit
+    toolkit = toorpia_remote_toolkit('bench', 'localhost', '/', 'true', str(os.getuid()), case['remote_dir'], persistent_session=False)
+    toolkit.remote_cmd_prefix = f"cd {case['remote_dir']};"
+    toolkit.toorpia_cmd = case['binaries']['toorpia']
+    toolkit.mkfftseg_cmd = case['binaries']['mkfftseg']
+    toolkit.mkcsvseg_cmd = case['binaries']['mkcsvseg']
+    result = getattr(toolkit, case['op'].split('-')[0])(case['params'])
+    if result is None:
+        raise RuntimeError('remote %s failed' % case['op'])
+    return len(result[0]), []
+
+def worker(case):
+    start = time.perf_counter()
+    n_points, stages = run_remote(case) if case['kind'].startswith('remote') else run_local(case)
+    wall = time.perf_counter() - start
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    print(json.dumps({
+        'wall_time': wall,
+        'points': n_points,
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'children_max_rss_kb': children.ru_maxrss,
+        'stages': [(stage['stage'], stage['wall_time']) for stage in stages],
+    }))
+
+def measure(case, env, repeat):
+    samples = []
+    for _ in range(repeat):
+        rv = subprocess.run([sys.executable, os.path.abspath(__file__), '--worker', json.dumps(case)],
+                            env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        if rv.returncode != 0:
+            raise RuntimeError('%s %s failed:\n%s' % (case['kind'], case['op'], rv.stderr))
+        samples.append(json.loads(rv.stdout.strip().splitlines()[-1]))
+    stages = {}
+    for sample in samples:
+        totals = {} # a stage can run more than once per operation, e.g. segment_format
+        for name, wall in sample['stages']:
+            totals[name] = totals.get(name, 0) + wall
+        for name, wall in totals.items():
+            stages.setdefault(name, []).append(wall)
+    return {
+        'wall_time': statistics.median(s['wall_time'] for s in samples),
+        'points': samples[-1]['points'],
+        'max_rss_kb': max(s['max_rss_kb'] for s in samples),
+        'children_max_rss_kb': max(s['children_max_rss_kb'] for s in samples),
+        'stages': {name: statistics.median(walls) for name, walls in stages.items()},
+    }
+
+def parse_value(value):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+def make_cases(args, tmp_dir, binaries):
+    # yields (kind, op, size_mib, reduce_factor, window_length, input file, case) in the order they must run
+    extra = dict(kv.split('=', 1) for kv in args.set)
+    extra = {key: parse_value(value) for key, value in extra.items()}
+    for size in args.sizes:
+        data_dir = os.path.join(tmp_dir, 'data-%g' % size)
+        os.makedirs(data_dir)
+        base_csv = os.path.join(data_dir, 'base.csv')
+        add_csv = os.path.join(data_dir, 'add.csv')
+        make_table_csv(base_csv, size, args.columns, 0)
+        make_table_csv(add_csv, size / 4, args.columns, 1)
+        type_weight = os.path.join(data_dir, 'type_weight.csv')
+        subprocess.run(f"{binaries['mkcsvseg']} -o {type_weight} {base_csv} > /dev/null", shell=True, check=True)
+        base_wav = os.path.join(data_dir, 'base.wav')
+        add_wav = os.path.join(data_dir, 'add.wav')
+        make_wav(base_wav, size, 0)
+        make_wav(add_wav, size / 4, 1)
+
+        for rf in args.reduce_factors:
+            working_dir = os.path.join(tmp_dir, 'table-%g-%d' % (size, rf))
+            options = dict({'rawdata': base_csv, 'working_dir': working_dir, 'type_weight': type_weight, 'window_size': args.window_size,
+                            'reduce_factor': rf, 'map_inspector': False, 'segment_cache': False}, **extra)
+            for op, rawdata, input_file in [('create_basemap', base_csv, base_csv), ('open_basemap', base_csv, working_dir + '/xy.dat'), ('addplot', add_csv, add_csv)]:
+                yield 'table', op, size, rf, None, input_file, {'kind': 'table', 'op': op, 'filter_cmd': binaries['filter'], 'options': dict(options, rawdata=rawdata)}
+
+        for wl in args.window_lengths:
+            working_dir = os.path.join(tmp_dir, 'sound-%g-%d' % (size, wl))
+            options = dict({'rawdata': base_wav, 'working_dir': working_dir, 'sampling_rate': SAMPLING_RATE, 'window_length': wl,
+                            'multi_filter_option': args.multi_filter, 'map_inspector': False, 'segment_cache': False}, **extra)
+            if args.multi_filter == '':
+                del options['multi_filter_option']
+            for op, rawdata in [('create_basemap', base_wav), ('addplot', add_wav)]:
+                yield 'sound', op, size, None, wl, rawdata, {'kind': 'sound', 'op': op, 'filter_cmd': binaries['filter'], 'options': dict(options, rawdata=rawdata)}
+
+        if args.no_remote:
+            continue
+        remote_dir = os.path.join(tmp_dir, 'remote-%g' % size)
+        os.makedirs(remote_dir)
+        for kind, base, add, params in [('remote-table', base_csv, add_csv, {'type_weight_csv': type_weight}),
+                                        ('remote-sound', base_wav, add_wav, {'window_length': args.window_lengths[0], 'sampling_rate': SAMPLING_RATE})]:
+            params = dict(params, upload=True) # repeated runs find the rawdata on the server already
+            for op, rawdata, binary_transfer in [('create_basemap', base, True), ('addplot', add, False), ('addplot-binary', add, True)]:
+                case = {'kind': kind, 'op': op, 'remote_dir': remote_dir, 'binaries': binaries, 'params': dict(params, rawdata=rawdata, binary_transfer=binary_transfer)}
+                yield kind, op, size, None, args.window_lengths[0] if kind == 'remote-sound' else None, rawdata, case
+
+def key_of(result):
+    return '%s/%s/%g/%s/%s' % (result['kind'], result['op'], result['size_mib'], result['reduce_factor'], result['window_length'])
+
+def compare(results, baseline_file, tolerance):
+    # report operations that got slower or bigger than the baseline by more than tolerance
+    with open(baseline_file) as f:
+        baseline = {key_of(result): result for result in json.load(f)['results']}
+    regressions = []
+    for result in results:
+        base = baseline.get(key_of(result))
+        if base is None:
+            continue
+        if result['mib_per_sec'] < base['mib_per_sec'] * (1 - tolerance):
+            regressions.append('%s: throughput %.2f -> %.2f MiB/s' % (key_of(result), base['mib_per_sec'], result['mib_per_sec']))
+        if result['max_rss_kb'] > base['max_rss_kb'] * (1 + tolerance):
+            regressions.append('%s: peak RSS %.1f -> %.1f MiB' % (key_of(result), base['max_rss_kb'] / 1024, result['max_rss_kb'] / 1024))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark toorpia.utils and the remote toolkit on synthetic data')
+    parser.add_argument('--sizes', type=float, nargs='+', default=[4, 16], help='rawdata sizes (MiB) of the basemap. addplot data is 1/4 of it')
+    parser.add_argument('--columns', type=int, default=16, help='number of columns of the table CSV')
+    parser.add_argument('--window-size', type=int, default=5, help='window_size (moving average) of table data')
+    parser.add_argument('--reduce-factors', type=int, nargs='+', default=[1, 10], help='reduce_factor values of table data')
+    parser.add_argument('--window-lengths', type=int, nargs='+', default=[1024, 4096], help='window_length values of sound data')
+    parser.add_argument('--multi-filter', default=':2000,8000:', help="multi_filter_option of sound data ('' to disable)")
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE', help='extra option for create_basemap/open_basemap/addplot, e.g. segment_format=binary')
+    parser.add_argument('--stubs', choices=['auto', 'always'], default='auto', help='use the stand-ins only for missing binaries (auto) or always')
+    parser.add_argument('--no-remote', action='store_true', help='skip the remote toolkit')
+    parser.add_argument('-n', '--repeat', type=int, default=3, help='runs per operation (median wall time, max peak RSS)')
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare with results saved by --save')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative slowdown / memory growth against the baseline')
+    parser.add_argument('--stages', action='store_true', help='show the wall time of each stage')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker is not None:
+        worker(json.loads(args.worker))
+        return
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix='toorpia-bench-') as tmp_dir:
+        bin_dir = os.path.join(tmp_dir, 'bin')
+        os.makedirs(bin_dir)
+        binaries = make_bin_dir(bin_dir, args.stubs)
+        env = dict(os.environ)
+        env['PATH'] = bin_dir + os.pathsep + env.get('PATH', '')
+        env['PYTHONPATH'] = REPO_DIR + os.pathsep + env.get('PYTHONPATH', '')
+        env['TOORPIA_HEADLESS'] = '1'
+        print('stand-ins: %s' % (', '.join(binaries['stubs']) if binaries['stubs'] else 'none'))
+
+        print('%-14s %-15s %8s %4s %6s %9s %10s %10s %12s' % ('kind', 'op', 'size[MiB]', 'rf', 'wl', 'wall[s]', 'MiB/s', 'RSS[MiB]', 'child RSS[MiB]'))
+        for kind, op, size, rf, wl, input_file, case in make_cases(args, tmp_dir, binaries):
+            result = measure(case, env, args.repeat)
+            input_mib = os.path.getsize(input_file) / 1024 ** 2
+            result.update({'kind': kind, 'op': op, 'size_mib': size, 'reduce_factor': rf, 'window_length': wl,
+                           'input_mib': input_mib, 'mib_per_sec': input_mib / result['wall_time']})
+            results.append(result)
+            print('%-14s %-15s %8g %4s %6s %9.3f %10.2f %10.1f %12.1f' % (kind, op, size, rf or '-', wl or '-', result['wall_time'], result['mib_per_sec'],
+                                                                    result['max_rss_kb'] / 1024, result['children_max_rss_kb'] / 1024))
+            if args.stages:
+                for name, wall in result['stages'].items():
+                    print('%-14s   %-30s %9.3f' % ('', name, wall))
+
+    if args.save is not None:
+        with open(args.save, 'w') as f:
+            json.dump({'stubs': binaries['stubs'], 'results': results}, f, indent=2)
+
+    if args.baseline is not None:
+        regressions = compare(results, args.baseline, args.tolerance)
+        for regression in regressions:
+            print('REGRESSION %s' % regression)
+        if len(regressions) > 0:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
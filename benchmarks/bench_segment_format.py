@@ -0,0 +1,52 @@
+import os
+import sys
+import time
+import argparse
+import tempfile
+import numpy
+
+# disk footprint and load time of segment files: CSV vs binary (.tseg).
+#   python benchmarks/bench_segment_format.py --rows 20000 --cols 512
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from toorpia import segment_format
+
+def timed(func, *args, **kwargs):
+    t = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - t, result
+
+def main():
+    parser = argparse.ArgumentParser(description='compare CSV and binary segment files')
+    parser.add_argument('--rows', type=int, default=20000, help='number of segments')
+    parser.add_argument('--cols', type=int, default=512, help='number of values per segment (e.g. FFT bins)')
+    args = parser.parse_args()
+
+    rng = numpy.random.default_rng(0)
+    segments = rng.random((args.rows, args.cols), dtype=numpy.float32) * 100
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        csv_file = os.path.join(tmp_dir, 'segments.csv')
+        numpy.savetxt(csv_file, segments, fmt='%.7g', delimiter=',')
+
+        t_to_binary, binary_file = timed(segment_format.csv_to_binary, csv_file)
+        t_to_csv, _ = timed(segment_format.binary_to_csv, binary_file, os.path.join(tmp_dir, 'roundtrip.csv'))
+        t_loadtxt, _ = timed(numpy.loadtxt, csv_file, delimiter=',', dtype=numpy.float32)
+        t_csv, _ = timed(lambda: numpy.concatenate([block for _, block in segment_format.iter_csv_blocks(csv_file)]))
+        t_binary, _ = timed(lambda: segment_format.load_binary(binary_file, mmap=False))
+        t_mmap, _ = timed(lambda: segment_format.load_binary(binary_file)[1].sum())
+
+        print('segments: %d x %d' % (args.rows, args.cols))
+        print('%-28s %12s' % ('disk footprint', 'MiB'))
+        print('%-28s %12.1f' % ('csv', os.path.getsize(csv_file) / 1024 ** 2))
+        print('%-28s %12.1f' % ('binary', os.path.getsize(binary_file) / 1024 ** 2))
+        print('%-28s %12s' % ('load / convert', 'sec'))
+        print('%-28s %12.3f' % ('csv (numpy.loadtxt)', t_loadtxt))
+        print('%-28s %12.3f' % ('csv (chunked parser)', t_csv))
+        print('%-28s %12.3f' % ('binary (read)', t_binary))
+        print('%-28s %12.3f' % ('binary (mmap + full scan)', t_mmap))
+        print('%-28s %12.3f' % ('csv -> binary', t_to_binary))
+        print('%-28s %12.3f' % ('binary -> csv', t_to_csv))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+import os
+import sys
+import time
+import argparse
+import numpy
+
+# batch nearest-neighbor queries of addplot points against the basemap: grid index vs brute force.
+#   python benchmarks/bench_spatial_index.py --base 200000 --add 100000 -k 5
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from toorpia.spatial_index import basemap_index
+
+def timed(func, *args, **kwargs):
+    t = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - t, result
+
+def brute_force_knn(base, x, y, k, chunk=256):
+    indices = numpy.empty((x.size, k), dtype=numpy.int64)
+    for start in range(0, x.size, chunk):
+        d = numpy.hypot(base[None, :, 0] - x[start:start + chunk, None], base[None, :, 1] - y[start:start + chunk, None])
+        indices[start:start + chunk] = numpy.argsort(d, axis=1)[:, :k]
+    return indices
+
+def main():
+    parser = argparse.ArgumentParser(description='compare the basemap grid index with brute force')
+    parser.add_argument('--base', type=int, default=200000, help='number of basemap points')
+    parser.add_argument('--add', type=int, default=100000, help='number of addplot points')
+    parser.add_argument('-k', type=int, default=5, help='number of nearest neighbors')
+    parser.add_argument('--radius', type=float, default=1.0, help='radius for radius_count')
+    parser.add_argument('--brute-force', type=int, default=2000, help='addplot points for the brute-force reference (0 to skip)')
+    args = parser.parse_args()
+
+    rng = numpy.random.default_rng(0)
+    # a few clusters of different spread, as basemaps usually are
+    centers = rng.random((20, 2)) * 100
+    base = (centers[rng.integers(0, 20, args.base)] + rng.standard_normal((args.base, 2)) * rng.random((args.base, 1)) * 5).astype(numpy.float32)
+    add = centers[rng.integers(0, 20, args.add)] + rng.standard_normal((args.add, 2)) * 5
+
+    t_build, index = timed(basemap_index.build, base)
+    t_knn, (_, indices) = timed(index.knn, add[:, 0], add[:, 1], args.k)
+    t_radius, _ = timed(index.radius_count, add[:, 0], add[:, 1], args.radius)
+
+    print('basemap points: %d, addplot points: %d, k: %d' % (args.base, args.add, args.k))
+    print('%-32s %10s' % ('', 'sec'))
+    print('%-32s %10.3f' % ('build index', t_build))
+    print('%-32s %10.3f' % ('knn (index)', t_knn))
+    print('%-32s %10.3f' % ('radius_count (index)', t_radius))
+    if args.brute_force > 0:
+        n = min(args.brute_force, args.add)
+        t_brute, reference = timed(brute_force_knn, base, add[:n, 0], add[:n, 1], args.k)
+        print('%-32s %10.3f' % ('knn (brute force, %d points)' % n, t_brute))
+        print('%-32s %10.3f' % ('knn (brute force, estimated)', t_brute * args.add / n))
+        print('nearest neighbor agrees: %s' % bool((reference[:, 0] == indices[:n, 0]).all()))
+
+if __name__ == '__main__':
+    main()
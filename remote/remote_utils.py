@@ -1,10 +1,28 @@
+import os
 import subprocess
 import sys
 import re
+import gzip
+import shlex
+import json
+import hashlib
+import uuid
+import shutil
+import asyncio
+import tempfile
+import threading
+import weakref
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+UPLOAD_CHUNK_SIZE = 8 * 1024 ** 2 # 8 MiB
+UPLOAD_RETRIES = 2                  # assembling an upload is retried when a shared chunk went away meanwhile
+CHUNK_EXPIRE_DAYS = 7               # chunks of uploads that were never completed are removed after this
+RESULT_CACHE_DIR = '.results'       # under working_dir
+RESULT_LOCK_STALE_MINUTES = 1       # an in-flight build whose lock has not been refreshed for this long is taken over
 
 class toorpia_remote_toolkit:
-    def __init__(self, ssh_user, ssh_host, toorpia_service_dir, docker_compose_cmd, analysis_user, working_dir):
+    def __init__(self, ssh_user, ssh_host, toorpia_service_dir, docker_compose_cmd, analysis_user, working_dir, persistent_session=True, session_persist=600, result_cache=False):
         if toorpia_service_dir[0] != '/':
             raise ValueError('toorpia_service_dir must be absolute path')
 
@@ -26,10 +44,64 @@ class toorpia_remote_toolkit:
         self.remote_cmd_prefix = f'cd {toorpia_service_dir}; {docker_compose_cmd} exec -T -u {analysis_user} -w {working_dir} toorpia'
 
         self.toorpia_cmd = "/usr/local/bin/toorpia"
+        self.mkfftseg_cmd = "/usr/local/bin/mkfftseg"
+        self.mkcsvseg_cmd = "/usr/local/bin/mkcsvseg"
+
+        # result cache: basemaps and addplots are built under content-addressed directories on the server
+        # (working_dir/.results/<key>), keyed by the identity of the input files and the options. a result that is
+        # already there is reused, one that another request is building is waited for. see make_cached_cmd
+        self.result_cache = result_cache
+        self.cache_dir = f'{working_dir}/{RESULT_CACHE_DIR}'
+        self.basemap_dir = None # result directory of the last create_basemap with result_cache
+
+        # persistent session: all commands of this instance are multiplexed over one authenticated ssh connection
+        # (OpenSSH ControlMaster). the master is kept for session_persist seconds after the last command and
+        # re-established before the next command if it has gone away.
+        self.control_dir = None
+        self.ssh_opts = []
+        if persistent_session:
+            self.control_dir = tempfile.mkdtemp(prefix='toorpia-ssh-')
+            self.control_opts = ['-o', f'ControlPath={self.control_dir}/%C']
+            self.session_persist = session_persist
+            self.session_lock = threading.Lock()
+            self.ssh_opts = self.control_opts + ['-o', 'ControlMaster=no'] # falls back to a direct connection if the master is lost
+            self._finalizer = weakref.finalize(self, toorpia_remote_toolkit._close_session, self.ssh_info, self.control_opts, self.control_dir)
+
+    @staticmethod
+    def _close_session(ssh_info, control_opts, control_dir):
+        subprocess.run(["ssh", *control_opts, "-O", "exit", ssh_info], shell=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        shutil.rmtree(control_dir, ignore_errors=True)
+
+    def open_session(self):
+        if self.control_dir is None:
+            return
+        with self.session_lock: # commands may be issued from several threads
+            rv = subprocess.run(["ssh", *self.control_opts, "-O", "check", self.ssh_info], shell=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            if rv.returncode == 0:
+                return
+            # start a detached master. its stdio must not be tied to the pipes of a command
+            subprocess.run(["ssh", *self.control_opts, "-o", "ControlMaster=yes", "-o", f"ControlPersist={self.session_persist}", "-f", "-N", self.ssh_info],
+                           shell=False, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def close(self):
+        if self.control_dir is not None:
+            self._finalizer()
+            self.control_dir = None
+            self.ssh_opts = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def ssh_cmd(self, cmd):
+        self.open_session()
+        return ["ssh", *self.ssh_opts, self.ssh_info, cmd]
 
     def exec_remote_cmd(self, cmd, get_output=False):
         if get_output:
-            ssh = subprocess.Popen(["ssh", self.ssh_info, cmd],
+            ssh = subprocess.Popen(self.ssh_cmd(cmd),
                             shell=False,
                             text=True,
                             stdout=subprocess.PIPE,
@@ -38,11 +110,36 @@ class toorpia_remote_toolkit:
 
             if result.size == 0:
                 error = ssh.stderr.readlines()
-                print >>sys.stderr, "ERROR: %s" % error
+                print("ERROR: %s" % error, file=sys.stderr)
             else:
                 return result[:,0], result[:,1]
         else:
-            subprocess.run(["ssh", self.ssh_info, cmd], shell=False)
+            subprocess.run(self.ssh_cmd(cmd), shell=False)
+
+    def make_pipeline_cmd(self, cmds, xy_file, compress=True):
+        # chain all cmds and send back the coordinates in xy_file, converted on the remote host
+        # to little-endian float32 (x, y) pairs, optionally gzipped.
+        to_binary_cmd = f"perl -ne 'print pack(q(f<f<), (split)[0,1])' {xy_file}"
+        if compress:
+            to_binary_cmd += ' | gzip -c -1'
+        return ' && '.join(f'{{ {c}; }}' for c in cmds + [to_binary_cmd])
+
+    def decode_binary_xy(self, returncode, stdout, stderr, compress=True):
+        data = stdout
+        if returncode == 0 and compress:
+            data = gzip.decompress(data)
+        if returncode != 0 or len(data) == 0:
+            print("ERROR: %s" % stderr.decode(errors='replace'), file=sys.stderr)
+            return None
+
+        result = np.frombuffer(data, dtype='<f4').reshape(-1, 2)
+        return result[:,0], result[:,1]
+
+    def exec_remote_pipeline(self, cmds, xy_file, compress=True):
+        # run all cmds and get the coordinates back in a single ssh invocation
+        cmd = self.make_pipeline_cmd(cmds, xy_file, compress)
+        ssh = subprocess.run(self.ssh_cmd(cmd), shell=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return self.decode_binary_xy(ssh.returncode, ssh.stdout, ssh.stderr, compress)
 
     def check_data_type(self, params):
         # regex for automatic checking wav file or csv (table) file. ignore case. 末尾に.gzがついていてもOKとする
@@ -67,61 +164,317 @@ class toorpia_remote_toolkit:
 
         return params
 
-    def create_basemap(self, params):
-        # check params
-        params = self.check_data_type(params)
+    def upload_file(self, local_path, remote_dir=None, chunk_size=UPLOAD_CHUNK_SIZE, retries=UPLOAD_RETRIES):
+        # upload a local file and return its remote path, remote_dir/<file id>/<basename> (remote_dir default:
+        # working_dir/rawdata). the path is content-addressed: files of the same name never overwrite each other, and
+        # a path that results were made from always keeps its contents.
+        # the file is sent as gzipped chunks into a chunk store (working_dir/.chunks) and then assembled on the
+        # server. chunks already on the server are skipped, so an interrupted or repeated upload only sends what is
+        # missing, and a changed file only sends the chunks that changed. chunks are kept after assembly and expire
+        # CHUNK_EXPIRE_DAYS after an upload last used them
+        if remote_dir is None:
+            remote_dir = f'{self.working_dir}/rawdata'
+        chunk_dir = f'{self.working_dir}/.chunks'
 
-        rawdata = params['rawdata']
-        option_str = ''
-        make_basesegment_cmd = ''
+        hashes = []
+        with open(local_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                hashes.append(hashlib.sha256(chunk).hexdigest())
+        manifest = ''.join(h + '\n' for h in hashes)
+        file_id = hashlib.sha256(manifest.encode()).hexdigest()
+        file_dir = f'{remote_dir}/{file_id[:16]}'
+        remote_path = f'{file_dir}/{os.path.basename(local_path)}'
+
+        for attempt in range(retries + 1):
+            # ask the server whether remote_path is there and which chunks it lacks. chunks that are there are
+            # touched, so that they are not expired while this upload uses them
+            query_cmd = (f'mkdir -p {shlex.quote(chunk_dir)} {shlex.quote(file_dir)} && cd {shlex.quote(chunk_dir)} && '
+                         f'echo "id $(cat {shlex.quote(remote_path + ".sha256")} 2>/dev/null)" && '
+                         'while read h; do if [ -e "$h" ]; then touch "$h"; else echo "$h"; fi; done')
+            ssh = subprocess.run(self.ssh_cmd(query_cmd), shell=False, input=manifest, text=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            if ssh.returncode != 0:
+                raise RuntimeError('upload of %s failed: %s' % (local_path, ssh.stderr))
+            lines = ssh.stdout.splitlines()
+            if lines[0].split()[1:] == [file_id]:
+                return remote_path
+            missing = set(lines[1:])
+
+            with open(local_path, 'rb') as f:
+                for i, h in enumerate(hashes):
+                    if h not in missing:
+                        continue
+                    missing.discard(h) # a chunk can occur more than once in a file
+                    f.seek(i * chunk_size)
+                    data = gzip.compress(f.read(chunk_size), compresslevel=1)
+                    # the chunk is verified and moved into place atomically, so the store never holds partial chunks
+                    put_cmd = (f'cd {shlex.quote(chunk_dir)} && gzip -dc > .tmp-{h}-$$ && '
+                               f'echo "{h}  .tmp-{h}-$$" | sha256sum -c --status && mv .tmp-{h}-$$ {h} || {{ rm -f .tmp-{h}-$$; exit 1; }}')
+                    ssh = subprocess.run(self.ssh_cmd(put_cmd), shell=False, input=data, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+                    if ssh.returncode != 0:
+                        raise RuntimeError('upload of %s failed: %s' % (local_path, ssh.stderr.decode(errors='replace')))
 
+            # the chunks are touched again, so that the expiry of another upload never removes them while they are
+            # assembled (touch -c: a chunk missing by now is not created empty, cat fails and the upload is retried)
+            tmp = shlex.quote(remote_path) + '.tmp-$$'
+            assemble_cmd = (f'cd {shlex.quote(chunk_dir)} && cat > .manifest-$$ && '
+                            f'if xargs touch -c < .manifest-$$ && xargs cat < .manifest-$$ > {tmp} && mv {tmp} {shlex.quote(remote_path)} && echo {file_id} > {shlex.quote(remote_path + ".sha256")}; '
+                            f'then status=0; else rm -f {tmp}; status=1; fi; rm -f .manifest-$$; '
+                            f'find . -maxdepth 1 -type f -mtime +{CHUNK_EXPIRE_DAYS} -delete; exit $status')
+            ssh = subprocess.run(self.ssh_cmd(assemble_cmd), shell=False, input=manifest, text=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            if ssh.returncode == 0:
+                return remote_path
+        raise RuntimeError('upload of %s failed: %s' % (local_path, ssh.stderr))
+
+    def upload(self, local_paths, remote_dir=None, max_workers=4):
+        # upload several files in parallel. returns the remote paths in the same order
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(lambda path: self.upload_file(path, remote_dir), local_paths))
+
+    def upload_rawdata(self, params):
+        # with params['upload'] = True, rawdata (and type_weight_csv) are local paths: upload them and
+        # return a copy of params pointing to the remote files
+        if params.get('upload') != True:
+            return params
+        params = dict(params)
+        local_paths = params['rawdata'].split()
+        if params.get('type_weight_csv') != None and params['type_weight_csv'] != '':
+            local_paths.append(params['type_weight_csv'])
+        remote_paths = self.upload(local_paths)
+        if params.get('type_weight_csv') != None and params['type_weight_csv'] != '':
+            params['type_weight_csv'] = remote_paths.pop()
+        params['rawdata'] = ' '.join(remote_paths)
+        return params
+
+    def segment_options(self, params):
+        # segmentation command and its options, without the input files
+        option_str = ''
         if params['rawdata_type'] == 'sound':
-            mkseg_cmd = "/usr/local/bin/mkfftseg"
+            mkseg_cmd = self.mkfftseg_cmd
             if params.get('window_length') != None and params['window_length'] != '' and params['window_length'] != None:
                 option_str += f' -wl {params["window_length"]}'
             if params.get('sampling_rate') != None and params['sampling_rate'] != '' and params['sampling_rate'] != None:
                 option_str += f' -sr {params["sampling_rate"]}'
-            make_basesegment_cmd = f'{self.remote_cmd_prefix} {mkseg_cmd} {option_str} {rawdata}  > {self.working_dir}/base_segments.csv 2> {self.working_dir}/base_segments.log'
-
         elif params['rawdata_type'] == 'table':
-            mkseg_cmd = "/usr/local/bin/mkcsvseg"
+            mkseg_cmd = self.mkcsvseg_cmd
+        return mkseg_cmd, option_str
+
+    def make_segment_cmd(self, params, segment_name, output_dir=None):
+        if output_dir is None:
+            output_dir = self.working_dir
+        rawdata = params['rawdata']
+        mkseg_cmd, option_str = self.segment_options(params)
+        if params['rawdata_type'] == 'table':
             if params.get('type_weight_csv') != None and params['type_weight_csv'] != '' and params['type_weight_csv'] != None:
                 option_str += f' -o {params["type_weight_csv"]}'
-            make_basesegment_cmd = f'{self.remote_cmd_prefix} {mkseg_cmd} {option_str} {rawdata}  > {self.working_dir}/base_segments.csv 2> {self.working_dir}/base_segments.log'
 
+        return f'{self.remote_cmd_prefix} {mkseg_cmd} {option_str} {rawdata}  > {output_dir}/{segment_name}.csv 2> {output_dir}/{segment_name}.log'
+
+    def result_material(self, params, mode):
+        # what a result depends on besides its input files. not the docker compose prefix (analysis_user, service dir),
+        # so that analysts sharing working_dir share the results
+        mkseg_cmd, option_str = self.segment_options(params)
+        return {'mode': mode, 'segment': [mkseg_cmd, option_str.strip()], 'toorpia': [self.toorpia_cmd, '-m', mode]}
+
+    def input_files(self, params):
+        # remote files whose contents the results depend on
+        files = params['rawdata'].split()
+        if params['rawdata_type'] == 'table' and params.get('type_weight_csv') != None and params['type_weight_csv'] != '':
+            files.append(params['type_weight_csv'])
+        return files
+
+    def result_key(self, material, files):
+        # key of a result on the server: material (options, commands) and the identity of every input file.
+        # uploaded files are identified by their content (the .sha256 written by upload_file), others by their
+        # real path, size and mtime on the server
+        key_cmd = ('{ printf "%s\\n" ' + shlex.quote(json.dumps(material, sort_keys=True)) + '; for f in ' + ' '.join(shlex.quote(f) for f in files) + '; do '
+                   'if [ -e "$f.sha256" ]; then cat "$f.sha256"; else readlink -f "$f"; stat -L -c "%s %Y" "$f"; fi; '
+                   'done; } | sha256sum | cut -c1-64')
+        ssh = subprocess.run(self.ssh_cmd(key_cmd), shell=False, text=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        key = ssh.stdout.strip()
+        if ssh.returncode != 0 or not re.match(r'^[0-9a-f]{64}$', key):
+            raise RuntimeError('result key could not be made: %s' % ssh.stderr)
+        return key
+
+    def make_cached_cmd(self, result_dir, build_cmds):
+        # one remote command that makes sure result_dir holds a finished result and builds it otherwise.
+        # build_cmds write into $tmp, which is renamed to result_dir when all of them have succeeded, so a result
+        # directory is always complete. the builder holds result_dir.lock (mkdir is atomic) and refreshes it while it
+        # runs. concurrent requests for the same result wait for it. a lock that is no longer refreshed (the builder
+        # was killed) is taken over. a failed build is kept in result_dir.failed for its logs.
+        # finished results are made read-only, so that nothing writes into them through a link
+        build = ' && '.join(f'{{ {c}; }}' for c in build_cmds)
+        d = result_dir
+        return (f'mkdir -p {self.cache_dir} && while [ ! -e {d}/done ]; do '
+                f'if mkdir {d}.lock 2>/dev/null; then '
+                f'( while kill -0 $$ 2>/dev/null && [ -d {d}.lock ]; do touch {d}.lock; sleep 10; done ) < /dev/null > /dev/null 2>&1 & heartbeat=$!; '
+                f'tmp={d}.tmp-$$; rm -rf $tmp; mkdir -p $tmp && {build} && touch $tmp/done && chmod a-w $tmp/* && {{ mv -T $tmp {d} 2>/dev/null || [ -e {d}/done ]; }}; status=$?; kill $heartbeat 2>/dev/null; '
+                f'if [ $status -ne 0 ]; then rm -rf {d}.failed; mv $tmp {d}.failed; echo "build failed. see {d}.failed" >&2; fi; '
+                f'rm -rf $tmp; rmdir {d}.lock; [ $status -eq 0 ] || exit $status; '
+                f'elif [ -n "$(find {d}.lock -maxdepth 0 -mmin +{RESULT_LOCK_STALE_MINUTES} 2>/dev/null)" ]; then rmdir {d}.lock 2>/dev/null; '
+                f'else sleep 1; fi; done')
+
+    def make_basemap_cmds(self, params):
+        # returns the remote commands to build a basemap and the remote path of its coordinates
+        params = self.check_data_type(params)
+
+        if self.result_cache:
+            material = self.result_material(params, 'base')
+            d = f'{self.cache_dir}/' + self.result_key(material, self.input_files(params))
+            build_cmds = [self.make_segment_cmd(params, 'base_segments', '$tmp'),
+                          f'{self.remote_cmd_prefix} {self.toorpia_cmd} -m base $tmp/base_segments.csv > $tmp/base-xy.dat 2> $tmp/base-xy.log']
+            # the fixed names of working_dir point to the last basemap built there, for addplots without a basemap_dir
+            link_cmds = [f'ln -sfn {d}/{name} {self.working_dir}/.{name}.tmp-$$ && mv -fT {self.working_dir}/.{name}.tmp-$$ {self.working_dir}/{name}' for name in ['base_segments.csv', 'base-xy.dat']]
+            self.basemap_dir = d
+            return [self.make_cached_cmd(d, build_cmds)] + link_cmds, f'{d}/base-xy.dat'
+
+        # the fixed names may be links into the result cache (result_cache). they are replaced, not written through
+        unlink_cmd = ' '.join(f'if [ -L {self.working_dir}/{name} ]; then rm -f {self.working_dir}/{name}; fi;' for name in ['base_segments.csv', 'base-xy.dat'])
+        make_basesegment_cmd = unlink_cmd + ' ' + self.make_segment_cmd(params, 'base_segments')
         make_basemap_cmd = f'{self.remote_cmd_prefix} {self.toorpia_cmd} -m base {self.working_dir}/base_segments.csv > {self.working_dir}/base-xy.dat 2> {self.working_dir}/base-xy.log'
-        self.exec_remote_cmd(make_basesegment_cmd)
-        self.exec_remote_cmd(make_basemap_cmd)
+        return [make_basesegment_cmd, make_basemap_cmd], f'{self.working_dir}/base-xy.dat'
+
+    def make_addplot_cmds(self, params):
+        # returns the remote commands to addplot and the remote path of its coordinates.
+        # params['job_name'] gives each job its own add_segments/add-xy files, e.g. for concurrent addplots
+        params = self.check_data_type(params)
+
+        if self.result_cache:
+            base_dir = self.basemap_dir if self.basemap_dir is not None else self.working_dir
+            base_files = [f'{base_dir}/base_segments.csv', f'{base_dir}/base-xy.dat']
+            material = self.result_material(params, 'add')
+            d = f'{self.cache_dir}/' + self.result_key(material, self.input_files(params) + base_files)
+            build_cmds = [self.make_segment_cmd(params, 'add_segments', '$tmp'),
+                          f'{self.remote_cmd_prefix} {self.toorpia_cmd} -m add {base_files[0]} {base_files[1]} $tmp/add_segments.csv > $tmp/add-xy.dat 2> $tmp/add-xy.log']
+            return [self.make_cached_cmd(d, build_cmds)], f'{d}/add-xy.dat'
+
+        suffix = ''
+        if params.get('job_name') != None and params['job_name'] != '':
+            suffix = '-' + params['job_name']
+
+        make_addsegment_cmd = self.make_segment_cmd(params, f'add_segments{suffix}')
+        make_addmap_cmd = f'{self.remote_cmd_prefix} {self.toorpia_cmd} -m add {self.working_dir}/base_segments.csv {self.working_dir}/base-xy.dat {self.working_dir}/add_segments{suffix}.csv > {self.working_dir}/add-xy{suffix}.dat 2> {self.working_dir}/add-xy{suffix}.log'
+        return [make_addsegment_cmd, make_addmap_cmd], f'{self.working_dir}/add-xy{suffix}.dat'
+
+    def run_remote_cmds(self, params, cmds, xy_file):
+        # single round trip: run the whole pipeline as one remote job and get the coordinates back in binary
+        if params.get('binary_transfer') == True:
+            return self.exec_remote_pipeline(cmds, xy_file, compress=params.get('compress_transfer', True))
+
+        for cmd in cmds:
+            self.exec_remote_cmd(cmd)
 
         # get data from remote host
-        get_base_xy_cmd = f'{self.remote_cmd_prefix} cat {self.working_dir}/base-xy.dat'
-        return self.exec_remote_cmd(get_base_xy_cmd, get_output=True)
+        get_xy_cmd = f'{self.remote_cmd_prefix} cat {xy_file}'
+        return self.exec_remote_cmd(get_xy_cmd, get_output=True)
+
+    def create_basemap(self, params):
+        params = self.upload_rawdata(params)
+        cmds, xy_file = self.make_basemap_cmds(params)
+        return self.run_remote_cmds(params, cmds, xy_file)
 
     def addplot(self, params):
-        # check params
-        params = self.check_data_type(params)
+        params = self.upload_rawdata(params)
+        cmds, xy_file = self.make_addplot_cmds(params)
+        return self.run_remote_cmds(params, cmds, xy_file)
 
-        rawdata = params['rawdata']
-        option_str = ''
-        make_addsegment_cmd = ''
+class toorpia_remote_toolkit_async:
+    # asyncio client on top of a toorpia_remote_toolkit. remote commands run as asyncio subprocesses,
+    # so that many jobs can be in flight from one event loop.
+    def __init__(self, toolkit):
+        self.toolkit = toolkit
 
-        if params['rawdata_type'] == 'sound':
-            mkseg_cmd = "/usr/local/bin/mkfftseg"
-            if params.get('window_length') != None and params['window_length'] != '' and params['window_length'] != None:
-                option_str += f' -wl {params["window_length"]}'
-            if params.get('sampling_rate') != None and params['sampling_rate'] != '' and params['sampling_rate'] != None:
-                option_str += f' -sr {params["sampling_rate"]}'
-            make_addsegment_cmd = f'{self.remote_cmd_prefix} {mkseg_cmd} {option_str} {rawdata}  > {self.working_dir}/add_segments.csv 2> {self.working_dir}/add_segments.log'
-        elif params['rawdata_type'] == 'table':
-            mkseg_cmd = "/usr/local/bin/mkcsvseg"
-            if params.get('type_weight_csv') != None and params['type_weight_csv'] != '' and params['type_weight_csv'] != None:
-                option_str += f' -o {params["type_weight_csv"]}'
-            make_addsegment_cmd = f'{self.remote_cmd_prefix} {mkseg_cmd} {option_str} {rawdata}  > {self.working_dir}/add_segments.csv 2> {self.working_dir}/add_segments.log'
+    async def ssh_cmd(self, cmd):
+        # (re)opening the ssh session blocks on the handshake, so it is done in a worker thread
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self.toolkit.ssh_cmd, cmd)
 
-        make_addmap_cmd = f'{self.remote_cmd_prefix} {self.toorpia_cmd} -m add {self.working_dir}/base_segments.csv {self.working_dir}/base-xy.dat {self.working_dir}/add_segments.csv > {self.working_dir}/add-xy.dat 2> {self.working_dir}/add-xy.log'
-        self.exec_remote_cmd(make_addsegment_cmd)
-        self.exec_remote_cmd(make_addmap_cmd)
+    async def exec_remote_cmd(self, cmd, get_output=False):
+        args = await self.ssh_cmd(cmd)
+        if get_output:
+            ssh = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+            stdout, stderr = await ssh.communicate()
+            result = np.array([line.split() for line in stdout.decode().splitlines()], dtype=np.float32)
 
-        # get data from remote host
-        get_add_xy_cmd = f'{self.remote_cmd_prefix} cat {self.working_dir}/add-xy.dat'
-        return self.exec_remote_cmd(get_add_xy_cmd, get_output=True)
+            if result.size == 0:
+                print("ERROR: %s" % stderr.decode(errors='replace'), file=sys.stderr)
+            else:
+                return result[:,0], result[:,1]
+        else:
+            ssh = await asyncio.create_subprocess_exec(*args)
+            await ssh.wait()
+
+    async def exec_remote_pipeline(self, cmds, xy_file, compress=True):
+        args = await self.ssh_cmd(self.toolkit.make_pipeline_cmd(cmds, xy_file, compress))
+        ssh = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        stdout, stderr = await ssh.communicate()
+        return self.toolkit.decode_binary_xy(ssh.returncode, stdout, stderr, compress)
+
+    async def run_remote_cmds(self, params, cmds, xy_file):
+        if params.get('binary_transfer') == True:
+            return await self.exec_remote_pipeline(cmds, xy_file, compress=params.get('compress_transfer', True))
+
+        for cmd in cmds:
+            await self.exec_remote_cmd(cmd)
+
+        get_xy_cmd = f'{self.toolkit.remote_cmd_prefix} cat {xy_file}'
+        return await self.exec_remote_cmd(get_xy_cmd, get_output=True)
+
+    async def create_basemap(self, params):
+        params = await asyncio.get_event_loop().run_in_executor(None, self.toolkit.upload_rawdata, params)
+        # with result_cache, the result key is asked from the server
+        cmds, xy_file = await asyncio.get_event_loop().run_in_executor(None, self.toolkit.make_basemap_cmds, params)
+        return await self.run_remote_cmds(params, cmds, xy_file)
+
+    async def addplot(self, params):
+        params = await asyncio.get_event_loop().run_in_executor(None, self.toolkit.upload_rawdata, params)
+        cmds, xy_file = await asyncio.get_event_loop().run_in_executor(None, self.toolkit.make_addplot_cmds, params)
+        return await self.run_remote_cmds(params, cmds, xy_file)
+
+class toorpia_host_pool:
+    # spreads jobs over several analysis servers (one toorpia_remote_toolkit per server),
+    # running at most max_jobs_per_host jobs on each server at a time. jobs go to the least busy server.
+    def __init__(self, toolkits, max_jobs_per_host=2):
+        if len(toolkits) == 0:
+            raise ValueError('at least one toolkit must be specified')
+        self.clients = [t if isinstance(t, toorpia_remote_toolkit_async) else toorpia_remote_toolkit_async(t) for t in toolkits]
+        self.max_jobs_per_host = max_jobs_per_host
+        self.active = [0] * len(self.clients)
+        self.cond = None
+
+    async def acquire(self, host=None):
+        if self.cond is None: # created lazily, inside the running event loop
+            self.cond = asyncio.Condition()
+        async with self.cond:
+            while True:
+                candidates = [host] if host is not None else range(len(self.clients))
+                i = min(candidates, key=lambda i: self.active[i])
+                if self.active[i] < self.max_jobs_per_host:
+                    self.active[i] += 1
+                    return i
+                await self.cond.wait()
+
+    async def release(self, i):
+        async with self.cond:
+            self.active[i] -= 1
+            self.cond.notify_all()
+
+    async def run(self, method, params, host=None):
+        i = await self.acquire(host)
+        try:
+            return await getattr(self.clients[i], method)(params)
+        finally:
+            await self.release(i)
+
+    async def create_basemap(self, params):
+        # every server needs the basemap for later addplots, so it is built on all of them
+        results = await asyncio.gather(*[self.run('create_basemap', dict(params), host=i) for i in range(len(self.clients))])
+        return results[0]
+
+    async def addplot(self, params):
+        params = dict(params)
+        if params.get('job_name') == None or params['job_name'] == '':
+            params['job_name'] = uuid.uuid4().hex[:12] # concurrent jobs on one server must not share output files
+        return await self.run('addplot', params)
+
+    async def addplot_many(self, params_list):
+        return await asyncio.gather(*[self.addplot(params) for params in params_list])
@@ -0,0 +1,183 @@
+import os
+import time
+import signal
+import threading
+import subprocess
+from concurrent.futures import Future
+
+# background jobs: create_basemap / addplot run in a worker thread and the caller gets a handle right away.
+#
+#   job = create_basemap_job(params)
+#   job.progress()      # [{'stage': 'mkcsvseg', 'state': 'done', 'wall_time': 1.2}, {'stage': 'toorpia', 'state': 'running', ...}]
+#   job.cancel()        # terminates the running commands
+#   x, y = job.result() # waits. raises job_error (job_cancelled) instead of exiting
+#
+# the job of the calling code is found through a thread-local slot, which submit() carries into worker threads.
+# commands started with popen() inside a job get their own process group, so that cancel() terminates the shell
+# together with the commands it runs.
+# jobs that run at the same time must use different working_dir (or output files).
+
+TERMINATE_TIMEOUT = 5.0 # seconds between SIGTERM and SIGKILL on cancel
+
+class job_error(RuntimeError):
+    pass
+
+class job_cancelled(job_error):
+    pass
+
+_local = threading.local()
+
+def current():
+    return getattr(_local, 'job', None)
+
+def _group_alive(pgid):
+    try:
+        os.killpg(pgid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+
+class toorpia_job:
+    def __init__(self, name, func, options):
+        self.name = name
+        self.options = options
+        self.future = Future()
+        self.lock = threading.Lock()
+        self.processes = []
+        self.stages = []
+        self.cancelled = False
+        self.thread = threading.Thread(target=self._run, args=(func,), name='toorpia-%s' % name, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def _run(self, func):
+        _local.job = self
+        self.future.set_running_or_notify_cancel()
+        try:
+            result = func(self.options)
+        except SystemExit:
+            self.future.set_exception(self._error('%s failed' % self.name))
+        except BaseException as e:
+            self.future.set_exception(job_cancelled('%s was cancelled' % self.name) if self.cancelled and not isinstance(e, job_cancelled) else e)
+        else:
+            self.future.set_result(result)
+        finally:
+            self._terminate(reap=True)
+
+    def _error(self, message):
+        return job_cancelled('%s was cancelled' % self.name) if self.cancelled else job_error(message)
+
+    def fail(self, message):
+        raise self._error(message)
+
+    def check(self):
+        if self.cancelled:
+            raise job_cancelled('%s was cancelled' % self.name)
+
+    def popen(self, cmd, **kwargs):
+        with self.lock: # no command is started once cancel() has begun terminating them
+            self.check()
+            proc = subprocess.Popen(cmd, shell=True, start_new_session=True, **kwargs)
+            self.processes = [p for p in self.processes if p.returncode is None] + [proc]
+        return proc
+
+    def stage_started(self, stage):
+        record = {'stage': stage, 'state': 'running', 'start': time.perf_counter(), 'wall_time': None}
+        with self.lock:
+            self.stages.append(record)
+        return record
+
+    def stage_finished(self, record, succeeded=True):
+        record['wall_time'] = time.perf_counter() - record['start']
+        record['state'] = 'done' if succeeded else ('cancelled' if self.cancelled else 'failed')
+
+    def progress(self):
+        # stages started so far, in order. running stages report the time since they started
+        now = time.perf_counter()
+        with self.lock:
+            return [{'stage': r['stage'], 'state': r['state'], 'wall_time': r['wall_time'] if r['wall_time'] is not None else now - r['start']}
+                    for r in self.stages]
+
+    def _terminate(self, reap=False):
+        # other threads only signal the processes: the thread that started them reaps them (os.wait4).
+        # when the job itself has finished, whatever is left is reaped here
+        with self.lock:
+            processes = [p for p in self.processes if p.returncode is None]
+        for sig in [signal.SIGTERM, signal.SIGKILL]:
+            for proc in processes:
+                try:
+                    os.killpg(proc.pid, sig)
+                except ProcessLookupError:
+                    pass
+            deadline = time.monotonic() + TERMINATE_TIMEOUT
+            while time.monotonic() < deadline:
+                processes = [p for p in processes if (p.poll() if reap else p.returncode) is None and _group_alive(p.pid)]
+                if len(processes) == 0:
+                    return
+                time.sleep(0.05)
+
+    def cancel(self):
+        # stop the job: running commands are terminated and no new one is started. stages that run in Python
+        # (e.g. the in-process filter) finish first. returns False if the job had already finished
+        if self.future.done():
+            return False
+        with self.lock:
+            self.cancelled = True
+        self._terminate()
+        return True
+
+    def status(self):
+        if not self.future.done():
+            return 'cancelling' if self.cancelled else 'running'
+        e = self.future.exception()
+        if e is None:
+            return 'succeeded'
+        return 'cancelled' if isinstance(e, job_cancelled) else 'failed'
+
+    def done(self):
+        return self.future.done()
+
+    def result(self, timeout=None):
+        return self.future.result(timeout)
+
+    def exception(self, timeout=None):
+        return self.future.exception(timeout)
+
+    def __repr__(self):
+        return '<toorpia_job %s %s>' % (self.name, self.status())
+
+def start(name, func, options):
+    return toorpia_job(name, func, options).start()
+
+def popen(cmd, **kwargs):
+    # subprocess.Popen(cmd, shell=True), attached to the current job if there is one
+    job = current()
+    if job is None:
+        return subprocess.Popen(cmd, shell=True, **kwargs)
+    return job.popen(cmd, **kwargs)
+
+def stage_started(stage):
+    job = current()
+    if job is None:
+        return None
+    job.check()
+    return job.stage_started(stage)
+
+def stage_finished(record, succeeded=True):
+    job = current()
+    if job is not None and record is not None:
+        job.stage_finished(record, succeeded)
+
+def _run_in_job(job, func, *args):
+    previous = current()
+    _local.job = job
+    try:
+        return func(*args)
+    finally:
+        _local.job = previous # executor threads are reused
+
+def submit(executor, func, *args):
+    # executor.submit that carries the current job into the worker thread
+    return executor.submit(_run_in_job, current(), func, *args)
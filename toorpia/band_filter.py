@@ -0,0 +1,120 @@
+import os
+import threading
+import numpy
+from toorpia.xy_loader import sidecar_path, sidecar_is_fresh, write_sidecar
+from toorpia.segment_format import iter_csv_blocks, is_header_line, DEFAULT_CHUNK_BYTES
+
+# in-process replacement of /usr/local/bin/filter for FFT segments made by mkfftseg.
+# every column of a segment row is taken as one FFT bin, starting at DC, with a spacing of
+# sampling_rate / window_length Hz. bins outside the bands of the filter string are set to 0.
+#
+#   segments = load_segments('analysis/segments.csv')
+#   for filter_str, masked in filter_sweep(segments, [':300,4000:5000', '4000:'], 48000, 65536):
+#       ...
+
+DEFAULT_CHUNK_ROWS = 65536
+
+def parse_bands(filter_str):
+    # ":300,4000:5000,20000:" -> [(None, 300.0), (4000.0, 5000.0), (20000.0, None)]
+    bands = []
+    for band in filter_str.split(','):
+        band = band.strip()
+        if band == '':
+            continue
+        if ':' not in band:
+            raise ValueError('invalid band in filter string: %s' % band)
+        low, high = band.split(':', 1)
+        bands.append((float(low) if low.strip() != '' else None, float(high) if high.strip() != '' else None))
+    if len(bands) == 0:
+        raise ValueError('no band in filter string: %s' % filter_str)
+    return bands
+
+def make_mask(filter_str, n_bins, sampling_rate, window_length):
+    # boolean mask of the bins to keep
+    freqs = numpy.arange(n_bins) * (float(sampling_rate) / float(window_length))
+    mask = numpy.zeros(n_bins, dtype=bool)
+    for low, high in parse_bands(filter_str):
+        band = numpy.ones(n_bins, dtype=bool)
+        if low is not None:
+            band &= freqs >= low
+        if high is not None:
+            band &= freqs <= high
+        mask |= band
+    return mask
+
+def parse_segments(segment_file, chunk_bytes=DEFAULT_CHUNK_BYTES):
+    # returns (header line or None, float32 array of shape (n_segments, n_bins)). parsed in chunks of rows
+    header = None
+    blocks = []
+    for header, block in iter_csv_blocks(segment_file, chunk_bytes):
+        blocks.append(block)
+    if len(blocks) == 0:
+        return header, numpy.empty((0, 0), dtype=numpy.float32)
+    return header, numpy.concatenate(blocks)
+
+def load_segments(segment_file, sidecar=True, mmap=True):
+    # like parse_segments, but the segments are cached in a float32 .npy sidecar and memory-mapped on later loads
+    if sidecar and sidecar_is_fresh(segment_file, sidecar_path(segment_file)):
+        with open(segment_file, 'r') as f:
+            first_line = f.readline()
+        header = first_line if is_header_line(first_line) else None
+        return header, numpy.load(sidecar_path(segment_file), mmap_mode='r' if mmap else None)
+
+    header, segments = parse_segments(segment_file)
+    if sidecar:
+        write_sidecar(segment_file, segments)
+    return header, segments
+
+def apply_mask(segments, mask, out=None, chunk_rows=DEFAULT_CHUNK_ROWS):
+    # zero the masked-out bins, chunk by chunk so that memory-mapped segments are never loaded at once
+    if out is None:
+        out = numpy.empty(segments.shape, dtype=numpy.float32)
+    for start in range(0, segments.shape[0], chunk_rows):
+        numpy.multiply(segments[start:start + chunk_rows], mask, out=out[start:start + chunk_rows])
+    return out
+
+def filter_segments(segments, filter_str, sampling_rate, window_length, out=None):
+    mask = make_mask(filter_str, segments.shape[1], sampling_rate, window_length)
+    return apply_mask(segments, mask, out=out)
+
+def filter_sweep(segments, filter_strs, sampling_rate, window_length):
+    # try several filter strings against one loaded segment set. the output buffer is reused between tries
+    out = numpy.empty(segments.shape, dtype=numpy.float32)
+    for filter_str in filter_strs:
+        yield filter_str, filter_segments(segments, filter_str, sampling_rate, window_length, out=out)
+
+def write_segments(segment_file, segments, header=None, chunk_rows=DEFAULT_CHUNK_ROWS):
+    # written to a temporary file first and renamed, so segment_file is never left half-written
+    tmp = '%s.tmp-%d-%d' % (segment_file, os.getpid(), threading.get_ident())
+    with open(tmp, 'w') as f:
+        if header is not None:
+            f.write(header)
+        for start in range(0, segments.shape[0], chunk_rows):
+            numpy.savetxt(f, segments[start:start + chunk_rows], fmt='%.7g', delimiter=',')
+    os.replace(tmp, segment_file)
+
+def filter_file(segment_file, filter_str, sampling_rate, window_length, output_file=None, chunk_bytes=DEFAULT_CHUNK_BYTES):
+    # filtered block by block, so only one block of segments is in memory whatever the size of segment_file.
+    # a fresh sidecar (load_segments) is read instead of the text. no sidecar is written for the output
+    output_file = segment_file if output_file is None else output_file
+    tmp = '%s.tmp-%d-%d' % (output_file, os.getpid(), threading.get_ident())
+    with open(segment_file, 'r') as f:
+        first_line = f.readline()
+    header = first_line if is_header_line(first_line) else None
+
+    if sidecar_is_fresh(segment_file, sidecar_path(segment_file)):
+        segments = numpy.load(sidecar_path(segment_file), mmap_mode='r')
+        blocks = (segments[start:start + DEFAULT_CHUNK_ROWS] for start in range(0, segments.shape[0], DEFAULT_CHUNK_ROWS))
+    else:
+        blocks = (block for _, block in iter_csv_blocks(segment_file, chunk_bytes))
+
+    mask = None
+    with open(tmp, 'w') as f:
+        if header is not None:
+            f.write(header)
+        for block in blocks:
+            if mask is None:
+                mask = make_mask(filter_str, block.shape[1], sampling_rate, window_length)
+            numpy.savetxt(f, apply_mask(block, mask), fmt='%.7g', delimiter=',')
+    segments = blocks = None # release the memory map before segment_file is replaced
+    os.replace(tmp, output_file)
@@ -0,0 +1,8 @@
+import os
+
+# headless entry point for batch workers and scripts: `from toorpia.headless import *`
+# same API as toorpia.utils, but nothing is printed on import. map_inspector, monitoring_scope and IPython
+# are only imported when they are actually used. the setting is inherited by child processes.
+os.environ['TOORPIA_HEADLESS'] = '1'
+
+from toorpia.utils import *
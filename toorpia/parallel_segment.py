@@ -0,0 +1,168 @@
+import os
+import re
+import gzip
+import shutil
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from toorpia import background
+from toorpia.segment_format import is_header_line
+
+# parallel segmentation.
+#
+# make_segments_per_file: several rawdata files (e.g. sound recordings for mkfftseg) are segmented concurrently,
+# one process per file, and the segments are concatenated in the original file order.
+#
+# make_segments: split-and-merge segmentation of one large table CSV (plain or .csv.gz) with mkcsvseg.
+# the rows are split into chunks that start at multiples of reduce_factor, so that decimation stays aligned with
+# the serial run. each chunk is preceded by enough rows of the previous chunk (context) to fill the moving average
+# window, and the segments produced for the context rows are dropped again when merging. their number is measured
+# once by segmenting the context length alone. this relies on mkcsvseg being row-wise: the segment of a row depends
+# only on that row and the preceding window_size - 1 rows, as with a fixed type_weight.csv.
+
+DEFAULT_CHUNK_BYTES = 64 * 1024 ** 2 # used for .csv.gz, whose uncompressed size is unknown
+
+def __open_text(path):
+    if re.match(r'^.*\.gz$', path, re.IGNORECASE):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+def context_rows(window_size, reduce_factor):
+    # rows of the previous chunk to prepend: at least window_size - 1, rounded up to a multiple of reduce_factor
+    window_size = max(int(window_size), 1)
+    reduce_factor = max(int(reduce_factor), 1)
+    return -(-(window_size - 1) // reduce_factor) * reduce_factor
+
+def split_csv(rawdata, chunk_dir, chunk_bytes, window_size=1, reduce_factor=1):
+    # write header + context + rows of every chunk to chunk_dir. returns the chunk files
+    reduce_factor = max(int(reduce_factor), 1)
+    n_context = context_rows(window_size, reduce_factor)
+    context = deque(maxlen=n_context if n_context > 0 else 1)
+    chunks = []
+
+    with __open_text(rawdata) as fin:
+        header = fin.readline()
+        fout = None
+        rows = 0
+        written = 0
+        for line in fin:
+            if fout is None:
+                chunk = os.path.join(chunk_dir, 'chunk-%06d.csv' % len(chunks))
+                chunks.append(chunk)
+                fout = open(chunk, 'wb')
+                fout.write(header)
+                if n_context > 0:
+                    fout.writelines(context)
+                rows = 0
+                written = 0
+            fout.write(line)
+            if n_context > 0:
+                context.append(line)
+            rows += 1
+            written += len(line)
+            if written >= chunk_bytes and rows % reduce_factor == 0 and rows >= n_context:
+                fout.close()
+                fout = None
+        if fout is not None:
+            fout.close()
+
+    return chunks, header, n_context
+
+def __run_segmentation(cmd_str, option_str, rawdata, segment_file):
+    log = segment_file + '.log'
+    returncode = background.popen(f"{cmd_str} {option_str} {rawdata} 2> {log} > {segment_file}").wait()
+    if returncode != 0:
+        raise RuntimeError(f"{cmd_str} command failed. see {log}")
+    return segment_file
+
+def __collect_logs(chunk_dir, log_file):
+    # keep the stderr of all processes in one log, as the serial run would
+    with open(log_file, 'wb') as log:
+        for name in sorted(os.listdir(chunk_dir)):
+            if name.endswith('.log'):
+                with open(os.path.join(chunk_dir, name), 'rb') as f:
+                    shutil.copyfileobj(f, log)
+
+def __count_segments(segment_file):
+    with open(segment_file, 'rb') as f:
+        lines = f.readlines()
+    return sum(1 for line in lines if not is_header_line(line))
+
+def context_segments(cmd_str, option_str, chunk, n_context, work_dir):
+    # number of segments that the first n_context rows of chunk (after its header) produce on their own
+    if n_context <= 0:
+        return 0
+    probe = os.path.join(work_dir, 'probe.csv')
+    with open(chunk, 'rb') as fin, open(probe, 'wb') as fout:
+        for _ in range(n_context + 1): # header + context rows
+            fout.write(fin.readline())
+    return __count_segments(__run_segmentation(cmd_str, option_str, probe, probe + '.seg'))
+
+def make_segments_per_file(cmd_str, option_str, rawdata_files, segment_file, work_dir, max_workers=None):
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+
+    chunk_dir = tempfile.mkdtemp(prefix='segment-files-', dir=work_dir)
+    try:
+        outputs = [os.path.join(chunk_dir, 'file-%06d.seg' % i) for i in range(len(rawdata_files))]
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [background.submit(executor, __run_segmentation, cmd_str, option_str, rawdata, output) for rawdata, output in zip(rawdata_files, outputs)]
+            for future in futures:
+                future.result()
+
+        with open(segment_file, 'wb') as fout:
+            for i, segment in enumerate(outputs):
+                with open(segment, 'rb') as fin:
+                    line = fin.readline()
+                    if i > 0 and is_header_line(line): # a header is written once, as by the serial run
+                        line = b''
+                    fout.write(line)
+                    shutil.copyfileobj(fin, fout)
+        return segment_file
+    except RuntimeError:
+        raise RuntimeError(f"{cmd_str} command failed. see {segment_file}.log")
+    finally:
+        __collect_logs(chunk_dir, segment_file + '.log')
+        shutil.rmtree(chunk_dir, ignore_errors=True)
+
+def make_segments(cmd_str, option_str, rawdata, segment_file, work_dir, window_size=1, reduce_factor=1, max_workers=None, chunk_bytes=None):
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    if chunk_bytes is None:
+        if re.match(r'^.*\.gz$', rawdata, re.IGNORECASE):
+            chunk_bytes = DEFAULT_CHUNK_BYTES
+        else:
+            chunk_bytes = max(os.path.getsize(rawdata) // max_workers + 1, 1024 ** 2)
+
+    chunk_dir = tempfile.mkdtemp(prefix='segment-chunks-', dir=work_dir)
+    try:
+        chunks, header, n_context = split_csv(rawdata, chunk_dir, chunk_bytes, window_size, reduce_factor)
+        if len(chunks) <= 1: # nothing to parallelize
+            shutil.move(__run_segmentation(cmd_str, option_str, rawdata, os.path.join(chunk_dir, 'serial.seg')), segment_file)
+            return segment_file
+
+        n_drop = context_segments(cmd_str, option_str, chunks[0], n_context, chunk_dir)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [background.submit(executor, __run_segmentation, cmd_str, option_str, chunk, chunk + '.seg') for chunk in chunks]
+            segments = [future.result() for future in futures]
+
+        with open(segment_file, 'wb') as fout:
+            for i, segment in enumerate(segments):
+                with open(segment, 'rb') as fin:
+                    if i == 0: # the first chunk has no context rows
+                        shutil.copyfileobj(fin, fout)
+                        continue
+                    line = fin.readline()
+                    if is_header_line(line):
+                        line = fin.readline()
+                    for _ in range(n_drop):
+                        line = fin.readline()
+                    fout.write(line)
+                    shutil.copyfileobj(fin, fout)
+        return segment_file
+    except RuntimeError:
+        raise RuntimeError(f"{cmd_str} command failed. see {segment_file}.log")
+    finally:
+        __collect_logs(chunk_dir, segment_file + '.log')
+        shutil.rmtree(chunk_dir, ignore_errors=True)
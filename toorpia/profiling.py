@@ -0,0 +1,150 @@
+import os
+import json
+import time
+import resource
+import datetime
+import threading
+import functools
+from toorpia import background
+
+# optional per-stage instrumentation of create_basemap / addplot (options['profile'] = True).
+#
+# every stage records wall time, CPU time, peak RSS and input/output bytes. child processes are measured with
+# wait4(), so their CPU time and peak RSS include the processes they spawned (e.g. the command run by the shell).
+# in-process stages report the CPU time and peak RSS of this Python process instead.
+# a JSON run report is written to working_dir/run_reports/ and options['profile_hook'], if set, is called with
+# each stage record as it completes, e.g. to forward it to a metrics collector.
+#
+# the active profiler is thread-local, so concurrent runs (addplot_batch) are reported separately.
+# stage boundaries are also reported to the background job (if any) as its progress.
+
+_local = threading.local()
+
+class run_profiler:
+    def __init__(self, run, hook=None):
+        self.run = run
+        self.hook = hook
+        self.run_id = '%s-%d-%d' % (datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f'), os.getpid(), threading.get_ident())
+        self.started_at = datetime.datetime.now().isoformat()
+        self.start = time.perf_counter()
+        self.stages = []
+
+    def record(self, stage, **metrics):
+        metrics = dict({'run': self.run, 'run_id': self.run_id, 'stage': stage}, **metrics)
+        self.stages.append(metrics)
+        if self.hook is not None:
+            self.hook(metrics)
+        return metrics
+
+    def report(self, status):
+        return {
+            'run': self.run,
+            'run_id': self.run_id,
+            'started_at': self.started_at,
+            'wall_time': time.perf_counter() - self.start,
+            'status': status,
+            'stages': self.stages,
+        }
+
+    def write_report(self, working_dir, status):
+        report_dir = os.path.join(working_dir, 'run_reports')
+        os.makedirs(report_dir, exist_ok=True)
+        path = os.path.join(report_dir, '%s-%s.json' % (self.run_id, self.run))
+        with open(path, 'w') as f:
+            json.dump(self.report(status), f, indent=2)
+        return path
+
+def current():
+    return getattr(_local, 'profiler', None)
+
+def _file_bytes(files):
+    total = 0
+    for file in files:
+        if file is not None and os.path.isfile(file):
+            total += os.path.getsize(file)
+    return total
+
+def profiled(run):
+    # decorator for functions taking an options dict. profiles the call when options['profile'] is True
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(options, *args, **kwargs):
+            if not ('profile' in options and options['profile'] == True) or current() is not None:
+                return func(options, *args, **kwargs)
+            _local.profiler = run_profiler(run, options.get('profile_hook'))
+            status = 'failed'
+            try:
+                result = func(options, *args, **kwargs)
+                status = 'succeeded'
+                return result
+            finally:
+                profiler = _local.profiler
+                _local.profiler = None
+                options['run_report'] = profiler.write_report(options.get('working_dir', 'analysis'), status)
+        return wrapper
+    return decorator
+
+def run(stage, cmd, inputs=(), outputs=()):
+    # subprocess.run(cmd, shell=True), measured when a profiler is active. returns the exit code
+    job_stage = background.stage_started(stage)
+    start = time.perf_counter()
+    proc = background.popen(cmd)
+    return wait(proc, stage, start, inputs, outputs, job_stage)
+
+def _exitcode_of(status):
+    # as subprocess: the exit code, or -signal if the child was killed (os.waitstatus_to_exitcode needs Python 3.9)
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+def wait(proc, stage, start, inputs=(), outputs=(), job_stage=None):
+    # wait for a child process started at start (time.perf_counter()) and record it. returns the exit code
+    profiler = current()
+    if profiler is None:
+        returncode = proc.wait()
+        background.stage_finished(job_stage, returncode == 0)
+        return returncode
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = _exitcode_of(status)
+    profiler.record(stage,
+                    wall_time=time.perf_counter() - start,
+                    cpu_time=usage.ru_utime + usage.ru_stime,
+                    peak_rss_kb=usage.ru_maxrss,
+                    input_bytes=_file_bytes(inputs),
+                    output_bytes=_file_bytes(outputs),
+                    returncode=proc.returncode,
+                    scope='child')
+    background.stage_finished(job_stage, proc.returncode == 0)
+    return proc.returncode
+
+class stage:
+    # context manager for in-process stages (or stages whose children are not waited for by run/wait)
+    def __init__(self, name, inputs=(), outputs=()):
+        self.name = name
+        self.inputs = inputs
+        self.outputs = outputs
+
+    def __enter__(self):
+        self.job_stage = background.stage_started(self.name)
+        self.start = time.perf_counter()
+        self.cpu = time.process_time()
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.children_cpu = children.ru_utime + children.ru_stime
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        background.stage_finished(self.job_stage, exc_type is None)
+        profiler = current()
+        if profiler is None:
+            return False
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        profiler.record(self.name,
+                        wall_time=time.perf_counter() - self.start,
+                        cpu_time=time.process_time() - self.cpu,
+                        children_cpu_time=children.ru_utime + children.ru_stime - self.children_cpu,
+                        peak_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                        children_peak_rss_kb=children.ru_maxrss,
+                        input_bytes=_file_bytes(self.inputs),
+                        output_bytes=_file_bytes(self.outputs),
+                        scope='process')
+        return False
@@ -0,0 +1,127 @@
+import os
+import re
+import gzip
+import wave
+from collections import deque
+from toorpia.segment_format import is_header_line
+
+# bounded windows of one long rawdata file (wav, wav.gz, csv, csv.gz), written one at a time for addplot_stream.
+#
+# every window starts with the carry (the last carry units of the previous window) followed by the units read next,
+# so the file holds at most carry + window units whatever the length of the rawdata. units are frames of a wav file and
+# data rows of a CSV; the CSV header is repeated in every window.
+#
+#   sound: carry = window_length - hop, where hop = window_length * (1 - segment_overlap_ratio / 100) is the distance
+#          between successive segments, and windows hold a whole number of hops. the segments of window k are then
+#          exactly those of one run over the whole range, starting at frame k * window (relies on mkfftseg starting a
+#          segment every hop frames from the first frame)
+#   table: carry = context rows for the moving average (see parallel_segment) that precede the window. the caller
+#          drops their segments
+#
+# start / end (units) restrict the range. plain wav files are read from start on by seeking, other files are read
+# up to start without being written (gzip has no random access). nothing after end is read.
+
+BLOCK_FRAMES = 65536 # frames read at a time from wav files
+
+def __is_gzip(path):
+    return re.match(r'^.*\.gz$', path, re.IGNORECASE) is not None
+
+def __open_binary(path):
+    if __is_gzip(path):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+def sound_windows(window_length, segment_overlap_ratio, window):
+    # returns (window, carry) in frames: window rounded up to whole hops, carry = the overlap of two segments
+    window_length = max(int(window_length), 1)
+    hop = max(int(round(window_length * (1 - float(segment_overlap_ratio) / 100))), 1)
+    window = max(-(-int(window) // hop), 1) * hop
+    return window, max(window_length - hop, 0)
+
+def wav_framerate(rawdata):
+    with __open_binary(rawdata) as f, wave.open(f, 'rb') as w:
+        return w.getframerate()
+
+def wav_windows(rawdata, window_dir, window, carry=0, start=0, end=None, min_frames=1):
+    # yields (first frame, window wav file). windows with fewer than min_frames frames (e.g. shorter than one
+    # segment at the end of the range) are not written. a window file is overwritten by the next one
+    with __open_binary(rawdata) as f, wave.open(f, 'rb') as w:
+        params = w.getparams()
+        frame_bytes = params.sampwidth * params.nchannels
+        end = params.nframes if end is None else min(int(end), params.nframes)
+        position = max(int(start), 0)
+        if position >= end:
+            return
+        w.setpos(position)
+
+        tail = b''
+        index = 0
+        while position < end:
+            n_read = min(window + (carry if index == 0 else 0), end - position - len(tail) // frame_bytes)
+            if n_read <= 0 or len(tail) // frame_bytes + n_read < min_frames:
+                break
+            window_file = os.path.join(window_dir, 'window.wav')
+            with wave.open(window_file, 'wb') as out:
+                out.setparams(params)
+                out.writeframes(tail)
+                while n_read > 0:
+                    frames = w.readframes(min(n_read, BLOCK_FRAMES))
+                    if len(frames) == 0:
+                        break
+                    out.writeframes(frames)
+                    tail = (tail + frames)[-carry * frame_bytes:] if carry > 0 else b''
+                    n_read -= len(frames) // frame_bytes
+            yield position, window_file
+            position += window
+            index += 1
+
+def csv_windows(rawdata, window_dir, window, carry=0, start=0, end=None, min_rows=1, context=False):
+    # yields (first row, window csv file, context rows in the window). rows are counted without the header line
+    # (if there is one). with context, the carried rows precede the first row of the window (table) instead of being
+    # its first rows (sound), and the first window is preceded by the rows before start
+    with __open_binary(rawdata) as f:
+        header = f.readline()
+        if not is_header_line(header): # e.g. a sound CSV without header
+            f.seek(0)
+            header = b''
+        tail = deque(maxlen=carry if carry > 0 else 1)
+        row = 0
+        while row < start:
+            line = f.readline()
+            if line == b'':
+                break
+            if context and carry > 0:
+                tail.append(line if line.endswith(b'\n') else line + b'\n')
+            row += 1
+        position = row
+
+        index = 0
+        while end is None or position < end:
+            carried = len(tail) if carry > 0 and (index > 0 or context) else 0
+            n_read = window + (carry if index == 0 and not context else 0)
+            if end is not None:
+                n_read = min(n_read, end - position - (0 if context else carried))
+            if n_read <= 0:
+                break
+            window_file = os.path.join(window_dir, 'window.csv')
+            n_new = 0
+            with open(window_file, 'wb') as out:
+                out.write(header)
+                out.writelines(tail if carry > 0 else [])
+                while n_new < n_read:
+                    line = f.readline()
+                    if line == b'':
+                        break
+                    if not line.endswith(b'\n'):
+                        line += b'\n'
+                    out.write(line)
+                    if carry > 0:
+                        tail.append(line)
+                    n_new += 1
+            if n_new == 0 or (0 if context else carried) + n_new < min_rows:
+                break
+            yield position, window_file, carried if context else 0
+            if n_new < n_read: # end of file
+                break
+            position += window
+            index += 1
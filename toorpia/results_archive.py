@@ -0,0 +1,198 @@
+import os
+import json
+import time
+import fcntl
+import bisect
+import hashlib
+import threading
+import numpy
+
+# append-only archive of addplot results, kept in working_dir/results_archive:
+#
+#   xy.f32       float32 (x, y) pairs of all entries, one entry after another. nothing is ever rewritten
+#   index.jsonl  one line per entry: id, timestamp, rawdata, options that shape the result, basemap identity,
+#                offset and count in xy.f32
+#
+#   archive = open_archive(working_dir)
+#   entry = archive.append(x, y, rawdata, options, base_xy)
+#   entries = archive.entries(rawdata='day1.wav', since=time.time() - 30 * 86400)
+#   x, y = archive.load(entries[-1])   # memory-mapped float32 arrays
+#
+# appends are serialized with a lock on index.jsonl, so that several processes (e.g. addplot_batch workers) can
+# share an archive. the coordinates are written before the index line, so readers never see an entry whose data is
+# incomplete. timestamps never decrease along the index, which keeps time range queries a binary search.
+# an append reads only the last line of the index (for the next id and timestamp), so it costs the same however long
+# the archive grows. the index is parsed when the archive is queried.
+
+ARCHIVE_DIR = 'results_archive'
+DATA_FILE = 'xy.f32'
+INDEX_FILE = 'index.jsonl'
+TAIL_BYTES = 4096 # read from the end of index.jsonl at a time to find its last line
+
+# options that change the coordinates of an addplot (segmentation and toorpia). paths of outputs, GUI and
+# performance options are not archived
+RESULT_OPTIONS = [
+    'rawdata_type', 'type_weight', 'window_size', 'reduce_factor',
+    'data_index', 'sampling_rate', 'window_length', 'window_function', 'high_pass_filter', 'low_pass_filter',
+    'n_moving_average', 'segment_overlap_ratio', 'multi_filter_option',
+    'disable_normalization', 'only_angle',
+]
+
+__basemap_ids = {} # (path, size, mtime_ns) of base_xy -> content hash
+__basemap_ids_lock = threading.Lock()
+
+def archive_dir_of(working_dir):
+    return os.path.join(working_dir, ARCHIVE_DIR)
+
+def basemap_identity(base_xy):
+    # the basemap is identified by the content of base_xy, so that a rebuilt basemap is told apart from the old one
+    st = os.stat(base_xy)
+    key = (os.path.abspath(base_xy), st.st_size, st.st_mtime_ns)
+    with __basemap_ids_lock:
+        digest = __basemap_ids.get(key)
+    if digest is None:
+        h = hashlib.sha256()
+        with open(base_xy, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        digest = h.hexdigest()
+        with __basemap_ids_lock:
+            __basemap_ids[key] = digest
+    return {'base_xy': key[0], 'sha256': digest}
+
+def _rawdata_of(rawdata):
+    return ' '.join(os.path.abspath(path) for path in rawdata.split())
+
+def _options_of(options):
+    return {key: options[key] for key in RESULT_OPTIONS if key in options}
+
+def _last_line(f):
+    # the last complete line of an open index file (b'' if there is none). a partial line left by an interrupted append
+    # is cut off, so that the next line does not run into it (the caller holds the lock)
+    end = f.seek(0, os.SEEK_END)
+    position = end
+    data = b''
+    while position > 0:
+        position = max(position - TAIL_BYTES, 0)
+        f.seek(position)
+        data = f.read(end - position)
+        last = data.rfind(b'\n')
+        if last < 0:
+            continue
+        if last + 1 < len(data):
+            f.truncate(position + last + 1)
+            data = data[:last + 1]
+            end = position + last + 1
+        previous = data.rfind(b'\n', 0, last)
+        if previous >= 0 or position == 0:
+            return data[previous + 1:last + 1]
+    if end > 0: # no newline at all
+        f.truncate(0)
+    return b''
+
+class results_archive:
+    def __init__(self, archive_dir):
+        self.archive_dir = archive_dir
+        self.data_file = os.path.join(archive_dir, DATA_FILE)
+        self.index_file = os.path.join(archive_dir, INDEX_FILE)
+        self.lock = threading.Lock()
+        self._entries = []
+        self._timestamps = []
+        self._index_offset = 0 # bytes of index.jsonl read so far
+
+    def _refresh(self):
+        # read the index lines appended since the last call. a line still being written is left for later
+        if not os.path.exists(self.index_file):
+            return
+        with open(self.index_file, 'rb') as f:
+            f.seek(self._index_offset)
+            data = f.read()
+        end = data.rfind(b'\n') + 1
+        for line in data[:end].splitlines():
+            if line.strip() == b'':
+                continue
+            entry = json.loads(line)
+            self._entries.append(entry)
+            self._timestamps.append(entry['timestamp'])
+        self._index_offset += end
+
+    def append(self, x, y, rawdata, options, base_xy):
+        # archive one addplot result and return its entry
+        xy = numpy.empty((len(x), 2), dtype=numpy.float32)
+        xy[:, 0] = x
+        xy[:, 1] = y
+        basemap = basemap_identity(base_xy)
+        os.makedirs(self.archive_dir, exist_ok=True)
+        with self.lock, open(self.index_file, 'a+b') as index:
+            fcntl.flock(index, fcntl.LOCK_EX)
+            try:
+                last = _last_line(index)
+                last = json.loads(last) if last.strip() != b'' else None
+                with open(self.data_file, 'ab') as data:
+                    offset = data.seek(0, os.SEEK_END) # not the end of the last entry: an interrupted append may have left bytes behind
+                    data.write(xy.tobytes())
+                    data.flush()
+                    os.fsync(data.fileno())
+                entry = {
+                    'id': 0 if last is None else last['id'] + 1,
+                    'timestamp': time.time() if last is None else max(time.time(), last['timestamp']),
+                    'rawdata': _rawdata_of(rawdata),
+                    'options': _options_of(options),
+                    'basemap': basemap,
+                    'offset': offset,
+                    'count': xy.shape[0],
+                }
+                index.write((json.dumps(entry, sort_keys=True) + '\n').encode('utf-8'))
+                index.flush()
+                os.fsync(index.fileno())
+            finally:
+                fcntl.flock(index, fcntl.LOCK_UN)
+        return entry
+
+    def __len__(self):
+        with self.lock:
+            self._refresh()
+            return len(self._entries)
+
+    def get(self, entry_id):
+        with self.lock:
+            self._refresh()
+            return self._entries[entry_id]
+
+    def entries(self, rawdata=None, basemap=None, since=None, until=None):
+        # entries in the order they were archived. since / until: timestamps (seconds since the epoch, until excluded).
+        # rawdata: path(s) as given to addplot. basemap: base_xy path or basemap identity (matches its content)
+        with self.lock:
+            self._refresh()
+            first = 0 if since is None else bisect.bisect_left(self._timestamps, since)
+            last = len(self._entries) if until is None else bisect.bisect_left(self._timestamps, until)
+            selected = self._entries[first:last]
+        if rawdata is not None:
+            rawdata = _rawdata_of(rawdata)
+            selected = [entry for entry in selected if entry['rawdata'] == rawdata]
+        if basemap is not None:
+            sha256 = basemap['sha256'] if isinstance(basemap, dict) else basemap_identity(basemap)['sha256']
+            selected = [entry for entry in selected if entry['basemap']['sha256'] == sha256]
+        return selected
+
+    def latest(self, **kwargs):
+        # the last entry that matches entries(**kwargs), or None
+        selected = self.entries(**kwargs)
+        return selected[-1] if len(selected) > 0 else None
+
+    def load(self, entry, mmap=True):
+        # x and y of an entry (or entry id) as float32 arrays, memory-mapped from xy.f32
+        if not isinstance(entry, dict):
+            entry = self.get(entry)
+        if entry['count'] == 0:
+            return numpy.empty(0, dtype=numpy.float32), numpy.empty(0, dtype=numpy.float32)
+        if mmap:
+            xy = numpy.memmap(self.data_file, dtype=numpy.float32, mode='r', offset=entry['offset'], shape=(entry['count'], 2))
+        else:
+            with open(self.data_file, 'rb') as f:
+                f.seek(entry['offset'])
+                xy = numpy.fromfile(f, dtype=numpy.float32, count=entry['count'] * 2).reshape(-1, 2)
+        return xy[:, 0], xy[:, 1]
+
+def open_archive(working_dir):
+    return results_archive(archive_dir_of(working_dir))
@@ -0,0 +1,95 @@
+import os
+import json
+import shutil
+import hashlib
+import threading
+
+# content-addressed cache of segment files (output of mkcsvseg / mkfftseg).
+# an entry is keyed by the segmentation command, its exact option string and the identity of every input file.
+
+DEFAULT_MAX_BYTES = 4 * 1024 ** 3 # 4 GiB
+ENTRY_SUFFIX = '.csv'
+
+def cache_dir_of(working_dir):
+    return os.path.join(working_dir, '.segment_cache')
+
+def __file_digest(path, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def file_identity(path, content_hash=False):
+    st = os.stat(path)
+    identity = [os.path.abspath(path), st.st_size, st.st_mtime_ns]
+    if content_hash:
+        identity.append(__file_digest(path))
+    return identity
+
+def make_key(cmd_str, option_str, files, content_hash=False):
+    # files: input files whose contents affect the segments (rawdata files, type_weight.csv, ...)
+    material = {
+        'cmd': cmd_str,
+        'option': option_str.strip(),
+        'files': [file_identity(file, content_hash) for file in files],
+    }
+    return hashlib.sha256(json.dumps(material, sort_keys=True).encode('utf-8')).hexdigest()
+
+def entry_path(cache_dir, key):
+    return os.path.join(cache_dir, key + ENTRY_SUFFIX)
+
+def fetch(cache_dir, key, dest):
+    # copy cached segments to dest. return True on cache hit.
+    # entries are copied rather than linked, since segment files are later overwritten in place by shell redirection.
+    entry = entry_path(cache_dir, key)
+    if not os.path.exists(entry):
+        return False
+    tmp = '%s.tmp-%d-%d' % (dest, os.getpid(), threading.get_ident()) # not mkstemp, dest gets the usual permissions
+    try:
+        shutil.copyfile(entry, tmp)
+    except FileNotFoundError: # evicted by another process in the meantime
+        os.remove(tmp)
+        return False
+    os.replace(tmp, dest)
+    os.utime(entry) # mark as recently used
+    return True
+
+def store(cache_dir, key, src, max_bytes=DEFAULT_MAX_BYTES):
+    os.makedirs(cache_dir, exist_ok=True)
+    entry = entry_path(cache_dir, key)
+    tmp = '%s.tmp-%d-%d' % (entry, os.getpid(), threading.get_ident())
+    shutil.copyfile(src, tmp)
+    os.replace(tmp, entry) # atomic, so concurrent readers never see partial entries
+    evict(cache_dir, max_bytes, keep=entry)
+
+def evict(cache_dir, max_bytes=DEFAULT_MAX_BYTES, keep=None):
+    # remove least recently used entries until the cache fits into max_bytes
+    if not os.path.isdir(cache_dir):
+        return
+    entries = []
+    for name in os.listdir(cache_dir):
+        if not name.endswith(ENTRY_SUFFIX):
+            continue
+        path = os.path.join(cache_dir, name)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+def clear(cache_dir):
+    if os.path.isdir(cache_dir):
+        shutil.rmtree(cache_dir)
@@ -0,0 +1,121 @@
+import os
+import re
+import json
+import struct
+import threading
+import numpy
+
+# compact binary format for segment files (.tseg).
+#
+#   magic (8 bytes) | n_cols (uint32) | n_rows (uint64) | meta_len (uint32) | meta (JSON, utf-8) | padding | data
+#
+# data is a row-major little-endian float32 matrix starting at a 64 byte aligned offset, so it can be memory-mapped.
+# meta holds the column names (the header line of the CSV, if any). values round-trip at float32 precision.
+
+MAGIC = b'TPSEG\x00\x01\x00'
+HEADER = struct.Struct('<8sIQI')
+ALIGN = 64
+SUFFIX = '.tseg'
+DEFAULT_CHUNK_BYTES = 64 * 1024 ** 2
+DEFAULT_CHUNK_ROWS = 65536
+
+def binary_path_of(csv_file):
+    # analysis/segments.csv -> analysis/segments.tseg
+    return os.path.splitext(csv_file)[0] + SUFFIX
+
+def is_binary(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def is_header_line(line):
+    # whether a line (str or bytes) of a CSV or of a whitespace separated file (e.g. xy.dat) is a header: it has a
+    # field that is not a number. letters do not tell: 1.26e-05, nan and inf are numbers
+    if isinstance(line, bytes):
+        line = line.decode('utf-8', errors='replace')
+    for field in re.split(r'[,\s]+', line.strip()):
+        if field == '':
+            continue
+        try:
+            float(field)
+        except ValueError:
+            return True
+    return False
+
+def iter_csv_blocks(csv_file, chunk_bytes=DEFAULT_CHUNK_BYTES):
+    # yields (header line or None, float32 block of rows), parsing about chunk_bytes of text at a time
+    with open(csv_file, 'r') as f:
+        header = None
+        first_line = f.readline()
+        if is_header_line(first_line):
+            header = first_line
+            first_line = f.readline()
+        if first_line.strip() == '':
+            return
+
+        lines = [first_line]
+        while True:
+            lines += f.readlines(chunk_bytes)
+            if len(lines) == 0:
+                break
+            yield header, numpy.loadtxt(lines, dtype=numpy.float32, delimiter=',', ndmin=2)
+            lines = []
+
+def __write_header(f, n_cols, n_rows, columns):
+    meta = json.dumps({'columns': columns, 'dtype': '<f4'}).encode('utf-8')
+    size = HEADER.size + len(meta)
+    meta += b' ' * (-size % ALIGN)
+    f.write(HEADER.pack(MAGIC, n_cols, n_rows, len(meta)))
+    f.write(meta)
+
+def __read_header(f):
+    magic, n_cols, n_rows, meta_len = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC:
+        raise ValueError('not a binary segment file: %s' % f.name)
+    meta = json.loads(f.read(meta_len).decode('utf-8'))
+    return n_cols, n_rows, meta, HEADER.size + meta_len
+
+def __tmp_path(path):
+    return '%s.tmp-%d-%d' % (path, os.getpid(), threading.get_ident())
+
+def csv_to_binary(csv_file, binary_file=None, chunk_bytes=DEFAULT_CHUNK_BYTES):
+    if binary_file is None:
+        binary_file = binary_path_of(csv_file)
+    tmp = __tmp_path(binary_file)
+    n_rows = 0
+    n_cols = 0
+    with open(tmp, 'wb') as f:
+        columns = None
+        for header, block in iter_csv_blocks(csv_file, chunk_bytes):
+            if n_rows == 0:
+                n_cols = block.shape[1]
+                columns = header.rstrip('\r\n').split(',') if header is not None else None
+                __write_header(f, n_cols, 0, columns)
+            f.write(block.astype('<f4', copy=False).tobytes())
+            n_rows += block.shape[0]
+        if n_rows == 0:
+            __write_header(f, 0, 0, None)
+        else: # n_rows is known only now
+            f.seek(len(MAGIC) + 4)
+            f.write(struct.pack('<Q', n_rows))
+    os.replace(tmp, binary_file)
+    return binary_file
+
+def load_binary(binary_file, mmap=True):
+    # returns (column names or None, float32 array of shape (n_rows, n_cols))
+    with open(binary_file, 'rb') as f:
+        n_cols, n_rows, meta, offset = __read_header(f)
+        if not mmap or n_rows == 0:
+            data = numpy.fromfile(f, dtype='<f4', count=n_rows * n_cols).reshape(n_rows, n_cols)
+            return meta['columns'], data
+    return meta['columns'], numpy.memmap(binary_file, dtype='<f4', mode='r', offset=offset, shape=(n_rows, n_cols))
+
+def binary_to_csv(binary_file, csv_file, chunk_rows=DEFAULT_CHUNK_ROWS):
+    columns, data = load_binary(binary_file)
+    tmp = __tmp_path(csv_file)
+    with open(tmp, 'w') as f:
+        if columns is not None:
+            f.write(','.join(columns) + '\n')
+        for start in range(0, data.shape[0], chunk_rows):
+            numpy.savetxt(f, data[start:start + chunk_rows], fmt='%.7g', delimiter=',')
+    os.replace(tmp, csv_file)
+    return csv_file
@@ -0,0 +1,239 @@
+import os
+import threading
+import numpy
+from toorpia.xy_loader import load_xy
+
+# uniform grid index over basemap coordinates (base_xy) for batch queries with arrays of addplot coordinates:
+# k nearest basemap points, number of basemap points within a radius and region labels carried over from the
+# nearest basemap points.
+#
+#   index = open_index('analysis/xy.dat')         # loaded from analysis/xy.dat.grid.npz, rebuilt if xy.dat changed
+#   distances, indices = index.knn(x_add, y_add, k=5)
+#   counts = index.radius_count(x_add, y_add, 0.5)
+#
+# points are bucketed into square cells of about POINTS_PER_CELL points each (the grid is refined for clustered
+# basemaps, up to MAX_CELLS_PER_POINT cells per point) and sorted by cell, so the points of a cell are a contiguous
+# slice. a query looks at the block of cells around it, growing the block until the answer is exact.
+# a grid rather than a KD-tree, so that only NumPy is needed.
+
+INDEX_SUFFIX = '.grid.npz'
+POINTS_PER_CELL = 4
+MAX_CELLS_PER_POINT = 16 # bound of the grid refinement for clustered basemaps
+QUERY_CHUNK = 16384
+MAX_CANDIDATES = 1 << 23 # (query, point) pairs evaluated at once
+
+def index_path(base_xy):
+    return base_xy + INDEX_SUFFIX
+
+class basemap_index:
+    def __init__(self, xy, origin, cell_size, shape, order, cell_start, source=None):
+        self.xy = xy                    # (n, 2) float32 basemap coordinates
+        self.origin = origin            # lower left corner of the grid
+        self.cell_size = cell_size
+        self.shape = shape              # (cells in x, cells in y)
+        self.order = order              # point indices sorted by cell
+        self.cell_start = cell_start    # points of cell c are order[cell_start[c]:cell_start[c + 1]]
+        self.source = source            # (st_size, st_mtime_ns) of base_xy the index was built from
+
+    @staticmethod
+    def build(xy, source=None):
+        xy = numpy.ascontiguousarray(xy, dtype=numpy.float32)
+        n = xy.shape[0]
+        if n == 0:
+            return basemap_index(xy, numpy.zeros(2), 1.0, (1, 1), numpy.zeros(0, dtype=numpy.int64), numpy.zeros(2, dtype=numpy.int64), source)
+        low = xy.min(axis=0).astype(numpy.float64)
+        extent = numpy.maximum(xy.max(axis=0) - low, 1e-12)
+        n_cells = max(n // POINTS_PER_CELL, 1)
+        cell_size = float(numpy.sqrt(extent[0] * extent[1] / n_cells)) if extent.min() > 1e-12 else float(extent.max() / n_cells)
+        cell_size = max(cell_size, float(extent.max()) / 65536, 1e-12) # bounded number of cells for degenerate layouts
+        shape = (int(extent[0] // cell_size) + 1, int(extent[1] // cell_size) + 1)
+        cells = basemap_index._cells_of(xy[:, 0], xy[:, 1], low, cell_size, shape)
+        # basemaps are clustered: refine the grid while a point's cell holds many more points than intended
+        while True:
+            load = float((numpy.bincount(cells).astype(numpy.float64) ** 2).sum() / n) # cell size seen by an average point
+            finer = (int(extent[0] // (cell_size / 2)) + 1, int(extent[1] // (cell_size / 2)) + 1)
+            if load <= 2 * POINTS_PER_CELL or finer[0] * finer[1] > max(MAX_CELLS_PER_POINT * n, 1 << 20):
+                break
+            cell_size /= 2
+            shape = finer
+            cells = basemap_index._cells_of(xy[:, 0], xy[:, 1], low, cell_size, shape)
+        order = numpy.argsort(cells, kind='stable')
+        cell_start = numpy.searchsorted(cells[order], numpy.arange(shape[0] * shape[1] + 1))
+        return basemap_index(xy, low, cell_size, shape, order, cell_start, source)
+
+    @staticmethod
+    def _cells_of(x, y, origin, cell_size, shape):
+        cx = numpy.clip(((numpy.asarray(x, dtype=numpy.float64) - origin[0]) // cell_size).astype(numpy.int64), 0, shape[0] - 1)
+        cy = numpy.clip(((numpy.asarray(y, dtype=numpy.float64) - origin[1]) // cell_size).astype(numpy.int64), 0, shape[1] - 1)
+        return cx * shape[1] + cy
+
+    def save(self, path):
+        tmp = '%s.tmp-%d-%d.npz' % (path, os.getpid(), threading.get_ident())
+        source = numpy.array(self.source if self.source is not None else (-1, -1), dtype=numpy.int64)
+        numpy.savez(tmp, xy=self.xy, origin=self.origin, cell_size=self.cell_size, shape=numpy.array(self.shape),
+                    order=self.order, cell_start=self.cell_start, source=source)
+        os.replace(tmp, path)
+        return path
+
+    @staticmethod
+    def load(path):
+        with numpy.load(path) as f:
+            source = tuple(int(v) for v in f['source'])
+            return basemap_index(f['xy'], f['origin'], float(f['cell_size']), tuple(int(v) for v in f['shape']),
+                                 f['order'], f['cell_start'], source if source != (-1, -1) else None)
+
+    def __len__(self):
+        return self.xy.shape[0]
+
+    def _ranges(self, x, y, reach):
+        # the cells within reach cells of each query, as one range of sorted points per grid column: (start, end) of
+        # shape (queries, 2 * reach + 1). also returns the distance from each query to the nearest side of its block
+        # that is not a border of the grid: points outside the block are at least that far away.
+        # queries outside the grid start from the nearest border cell
+        cell = self._cells_of(x, y, self.origin, self.cell_size, self.shape)
+        cx, cy = cell // self.shape[1], cell % self.shape[1]
+        columns = cx[:, None] + numpy.arange(-reach, reach + 1)
+        valid = (columns >= 0) & (columns < self.shape[0])
+        columns = numpy.clip(columns, 0, self.shape[0] - 1) * self.shape[1]
+        low = numpy.maximum(cy - reach, 0)[:, None]
+        high = numpy.minimum(cy + reach, self.shape[1] - 1)[:, None]
+        start = numpy.where(valid, self.cell_start[columns + low], 0)
+        end = numpy.where(valid, self.cell_start[columns + high + 1], 0)
+
+        bound = numpy.full(x.size, numpy.inf)
+        for c, v, axis in [(cx, x, 0), (cy, y, 1)]:
+            inner = c - reach > 0
+            bound[inner] = numpy.minimum(bound[inner], v[inner] - (self.origin[axis] + (c[inner] - reach) * self.cell_size))
+            inner = c + reach < self.shape[axis] - 1
+            bound[inner] = numpy.minimum(bound[inner], self.origin[axis] + (c[inner] + reach + 1) * self.cell_size - v[inner])
+        return start, end, bound
+
+    def _pairs(self, start, end):
+        # flatten the ranges to (query, point) pairs
+        lengths = (end - start).ravel()
+        total = int(lengths.sum())
+        query = numpy.repeat(numpy.repeat(numpy.arange(start.shape[0]), start.shape[1]), lengths)
+        offset = numpy.arange(total) - numpy.repeat(numpy.cumsum(lengths) - lengths, lengths)
+        return query, self.order[numpy.repeat(start.ravel(), lengths) + offset]
+
+    def _batches(self, queries, x, y, reach):
+        # yields (queries, (query, point) pairs, bound) in batches of about MAX_CANDIDATES pairs
+        step = max(min(QUERY_CHUNK, MAX_CANDIDATES // (2 * reach + 1)), 1)
+        for i in range(0, queries.size, step):
+            q = queries[i:i + step]
+            start, end, bound = self._ranges(x[q], y[q], reach)
+            pairs = numpy.cumsum((end - start).sum(axis=1))
+            first = 0
+            while first < q.size:
+                # at least one query per batch, however many points its block holds
+                last = max(int(numpy.searchsorted(pairs, pairs[first] - (end[first] - start[first]).sum() + MAX_CANDIDATES, side='right')), first + 1)
+                query, points = self._pairs(start[first:last], end[first:last])
+                yield q[first:last], query, points, bound[first:last]
+                first = last
+
+    def knn(self, x, y, k=1):
+        # returns (distances, indices), both of shape (len(x), k), sorted by distance.
+        # missing neighbors (k > len(self)) are inf / -1
+        x = numpy.atleast_1d(numpy.asarray(x, dtype=numpy.float64))
+        y = numpy.atleast_1d(numpy.asarray(y, dtype=numpy.float64))
+        distances = numpy.full((x.size, k), numpy.inf)
+        indices = numpy.full((x.size, k), -1, dtype=numpy.int64)
+        if len(self) == 0 or x.size == 0:
+            return distances, indices
+        k_found = min(k, len(self))
+
+        # every query starts with the 3x3 block around it. a query whose k-th neighbor may lie outside its block is
+        # searched again with a block large enough to hold that neighbor. reaches are powers of 2, so that
+        # queries are processed in a few groups
+        max_reach = max(self.shape)
+        reach = numpy.ones(x.size, dtype=numpy.int64)
+        pending = numpy.arange(x.size)
+        while pending.size > 0:
+            unresolved = []
+            for r in numpy.unique(reach[pending]):
+                for q, query, points, bound in self._batches(pending[reach[pending] == r], x, y, int(r)):
+                    d = numpy.hypot(self.xy[points, 0] - x[q][query], self.xy[points, 1] - y[q][query])
+                    # only candidates that can still be among the k nearest are sorted: those nearer than the k-th
+                    # neighbor found so far and, if the block holds k of them, those within the block's bound
+                    keep = d <= distances[q, k_found - 1][query]
+                    within = d <= bound[query]
+                    enough = numpy.bincount(query[keep & within], minlength=q.size) >= k_found
+                    keep &= within | ~enough[query]
+                    query, points, d = query[keep], points[keep], d[keep]
+                    order = numpy.lexsort((d, query))
+                    query, points, d = query[order], points[order], d[order]
+                    first = numpy.searchsorted(query, numpy.arange(q.size))
+                    count = numpy.searchsorted(query, numpy.arange(q.size), side='right') - first
+                    rank = numpy.arange(query.size) - numpy.repeat(first, count)
+                    keep = rank < k_found
+                    distances[q[query[keep]], rank[keep]] = d[keep]
+                    indices[q[query[keep]], rank[keep]] = points[keep]
+
+                    kth = distances[q, k_found - 1]
+                    again = (count < k_found) | (kth > bound)
+                    needed = numpy.where(count[again] < k_found, 2 * r, numpy.ceil(kth[again] / self.cell_size) + 1)
+                    needed = 2 ** numpy.ceil(numpy.log2(numpy.maximum(needed, 2 * r))).astype(numpy.int64)
+                    reach[q[again]] = numpy.minimum(needed, max_reach)
+                    unresolved.append(q[again & (r < max_reach)]) # a block of max_reach covers the whole grid
+            pending = numpy.concatenate(unresolved)
+        return distances, indices
+
+    def radius_count(self, x, y, radius):
+        # number of basemap points within radius of each query point
+        x = numpy.atleast_1d(numpy.asarray(x, dtype=numpy.float64))
+        y = numpy.atleast_1d(numpy.asarray(y, dtype=numpy.float64))
+        counts = numpy.zeros(x.size, dtype=numpy.int64)
+        if len(self) == 0:
+            return counts
+        reach = min(int(numpy.ceil(radius / self.cell_size)), max(self.shape))
+        for q, query, points, _ in self._batches(numpy.arange(x.size), x, y, reach):
+            inside = numpy.hypot(self.xy[points, 0] - x[q][query], self.xy[points, 1] - y[q][query]) <= radius
+            counts[q] = numpy.bincount(query[inside], minlength=q.size)
+        return counts
+
+    def region_labels(self, x, y, labels, k=1, max_distance=None, fill=-1):
+        # label of each query point: the label of its nearest basemap point, or the most frequent label among its
+        # k nearest. labels has one entry per basemap point (in base_xy order). points farther than max_distance
+        # from every basemap point get fill
+        labels = numpy.asarray(labels)
+        if labels.shape[0] != len(self):
+            raise ValueError('labels must have one entry per basemap point (%d), got %d' % (len(self), labels.shape[0]))
+        distances, indices = self.knn(x, y, k)
+        neighbor_labels = labels[numpy.maximum(indices, 0)]
+        if k == 1:
+            result = neighbor_labels[:, 0]
+        else:
+            values, codes = numpy.unique(neighbor_labels, return_inverse=True)
+            codes = codes.reshape(neighbor_labels.shape)
+            votes = numpy.zeros((codes.shape[0], values.size), dtype=numpy.int64)
+            for j in range(k):
+                numpy.add.at(votes, (numpy.arange(codes.shape[0]), codes[:, j]), (indices[:, j] >= 0).astype(numpy.int64))
+            result = values[votes.argmax(axis=1)]
+        outside = indices[:, 0] < 0
+        if max_distance is not None:
+            outside |= distances[:, 0] > max_distance
+        return numpy.where(outside, fill, result) if outside.any() else result
+
+def source_of(base_xy):
+    st = os.stat(base_xy)
+    return (st.st_size, st.st_mtime_ns)
+
+def open_index(base_xy, path=None):
+    # the index is saved next to base_xy and rebuilt only when base_xy has changed since
+    if path is None:
+        path = index_path(base_xy)
+    source = source_of(base_xy)
+    if os.path.exists(path):
+        try:
+            index = basemap_index.load(path)
+            if index.source == source:
+                return index
+        except (OSError, ValueError, KeyError): # unreadable index, e.g. written by an interrupted process
+            pass
+    x, y = load_xy(base_xy)
+    index = basemap_index.build(numpy.column_stack([x, y]), source)
+    try:
+        index.save(path)
+    except OSError: # the index is only an accelerator. e.g. read-only working_dir
+        pass
+    return index
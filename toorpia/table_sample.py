@@ -0,0 +1,159 @@
+import os
+import re
+import gzip
+import random
+from collections import Counter
+
+# bounded row samples of table CSVs (plain or .csv.gz), used to make type_weight.csv without reading the whole rawdata.
+#
+#   head:      the first rows of each file
+#   stride:    evenly spaced rows. plain files are read by seeking to the row offsets, .csv.gz files are decompressed
+#              in one pass (the uncompressed size is estimated from the gzip trailer) without parsing the skipped rows
+#   reservoir: uniform random rows (reads the whole file)
+#
+# rows are kept as text lines, so the sample can be fed to mkcsvseg as is. quoted fields spanning lines are not supported.
+
+SAMPLE_METHODS = ['head', 'stride', 'reservoir']
+MISSING_VALUES = ['', 'na', 'nan', 'null', 'none', '-']
+
+def __is_gzip(path):
+    return re.match(r'^.*\.gz$', path, re.IGNORECASE) is not None
+
+def __open_text(path):
+    if __is_gzip(path):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+def __estimated_size(path):
+    # uncompressed size. the gzip trailer holds it modulo 2**32, taken as at least the compressed size
+    size = os.path.getsize(path)
+    if not __is_gzip(path):
+        return size
+    with open(path, 'rb') as f:
+        f.seek(-4, os.SEEK_END)
+        isize = int.from_bytes(f.read(4), 'little')
+    while isize < size:
+        isize += 2 ** 32
+    return isize
+
+def __head(path, n_rows):
+    with __open_text(path) as f:
+        header = f.readline()
+        rows = []
+        for line in f:
+            if len(rows) >= n_rows:
+                break
+            rows.append(line)
+    return header, rows
+
+def __stride_seek(path, n_rows):
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        header = f.readline()
+        start = f.tell()
+        rows = []
+        end = start # end of the last row taken, so that no row is taken twice
+        for i in range(n_rows):
+            offset = start + (size - start) * i // n_rows
+            if offset < end:
+                continue
+            f.seek(offset)
+            if offset > start:
+                f.readline() # skip to the beginning of the next row
+            line = f.readline()
+            if line == b'':
+                break
+            rows.append(line)
+            end = f.tell()
+    return header, rows
+
+def __stride_stream(path, n_rows):
+    with __open_text(path) as f:
+        header = f.readline()
+        rows = []
+        stride = None
+        for i, line in enumerate(f):
+            if stride is None: # row length from the first row
+                stride = max(__estimated_size(path) // max(len(line), 1) // n_rows, 1)
+            if i % stride == 0:
+                rows.append(line)
+                if len(rows) >= n_rows:
+                    break
+    return header, rows
+
+def __reservoir(path, n_rows, rng):
+    with __open_text(path) as f:
+        header = f.readline()
+        rows = []
+        for i, line in enumerate(f):
+            if i < n_rows:
+                rows.append(line)
+            else:
+                j = rng.randint(0, i)
+                if j < n_rows:
+                    rows[j] = line
+    return header, rows
+
+def sample_rows(rawdata_files, n_rows, method='stride', seed=0):
+    # returns (header line, sampled row lines) as bytes. n_rows are shared by the files in proportion to their size
+    if method not in SAMPLE_METHODS:
+        raise ValueError('unknown sample method: %s' % method)
+    sizes = [__estimated_size(path) for path in rawdata_files]
+    total = max(sum(sizes), 1)
+    rng = random.Random(seed)
+
+    header = None
+    rows = []
+    for path, size in zip(rawdata_files, sizes):
+        n = max(int(n_rows * size / total), 1)
+        if method == 'head':
+            file_header, file_rows = __head(path, n)
+        elif method == 'reservoir':
+            file_header, file_rows = __reservoir(path, n, rng)
+        elif __is_gzip(path):
+            file_header, file_rows = __stride_stream(path, n)
+        else:
+            file_header, file_rows = __stride_seek(path, n)
+        if header is None:
+            header = file_header
+        rows += [row if row.endswith(b'\n') else row + b'\n' for row in file_rows]
+    return header, rows
+
+def write_sample(path, header, rows):
+    with open(path, 'wb') as f:
+        f.write(header)
+        f.writelines(rows)
+    return path
+
+def __is_number(value):
+    try:
+        float(value)
+        return True
+    except ValueError:
+        return False
+
+def ambiguous_columns(header, rows):
+    # columns whose type or weight may come out differently from a run over the full rawdata. returns {column: reason}
+    names = header.decode(errors='replace').rstrip('\r\n').split(',')
+    values = [[] for _ in names]
+    for row in rows:
+        fields = row.decode(errors='replace').rstrip('\r\n').split(',')
+        for i in range(min(len(fields), len(names))):
+            values[i].append(fields[i].strip())
+
+    ambiguous = {}
+    for name, column in zip(names, values):
+        present = [v for v in column if v.lower() not in MISSING_VALUES]
+        numeric = [v for v in present if __is_number(v)]
+        distinct = Counter(present)
+        if len(present) == 0:
+            ambiguous[name] = 'no values in the sample'
+        elif 0 < len(numeric) < len(present):
+            ambiguous[name] = 'mixed numeric (%d) and non-numeric (%d) values' % (len(numeric), len(present) - len(numeric))
+        elif len(distinct) == 1:
+            ambiguous[name] = 'constant in the sample'
+        elif len(numeric) == len(present) and len(distinct) <= 2 and len(present) >= 10:
+            ambiguous[name] = 'only %d distinct numeric values, may be a category code' % len(distinct)
+        elif len(numeric) == 0 and min(distinct.values()) == 1:
+            ambiguous[name] = 'categories seen only once in the sample, the full data may have more'
+    return ambiguous
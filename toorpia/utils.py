@@ -1,11 +1,27 @@
 import os
+import re
 import sys
+import json
+import time
+import shutil
+import tempfile
+import threading
 import subprocess
 import numpy
-from map_inspector.map_inspector import map_inspector
-from monitoring_scope.monitoring_scope import monitoring_scope
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from numpy import float32
-from IPython.display import display, HTML
+from toorpia import segment_cache
+from toorpia import parallel_segment
+from toorpia import band_filter
+from toorpia import segment_format
+from toorpia import profiling
+from toorpia import table_sample
+from toorpia import spatial_index
+from toorpia import background
+from toorpia import rawdata_window
+from toorpia import results_archive
+from toorpia.xy_loader import load_xy
+from toorpia.background import job_error, job_cancelled
 
 # show help when user imports this library
 help_string = '''
@@ -13,9 +29,41 @@ This is toorPIA Utility. The following commands are available.
     create_type_weight(params): create type_weight.csv
     create_basemap(params):     create a basemap
     addplot(params):            addplot to specified basename
+    addplot_batch(params, files): addplot many rawdata files in parallel
+    watch_addplot(params, dir):   addplot new rawdata files in dir as they arrive
+    addplot_stream(params, window, start, end): addplot one long rawdata file window by window. yields (x, y)
+    addplot_multi(params, basemaps): segment rawdata once and addplot it to several basemaps in parallel
+    create_basemap_job(params):   create a basemap in the background. returns a job handle (progress, cancel, result)
+    addplot_job(params):          addplot in the background. returns a job handle
+    open_basemap_index(params):   spatial index of the basemap for nearest point / radius / region queries
+    open_results_archive(params): addplot results archived with results_archive=True, for historical comparisons
     show_params():              show all available parameters
 '''.strip()
-print(help_string)
+# set TOORPIA_HEADLESS=1 (or import toorpia.headless) to suppress this banner, e.g. in batch workers
+if os.environ.get('TOORPIA_HEADLESS', '') in ('', '0'):
+    print(help_string)
+
+FILTER_CMD = '/usr/local/bin/filter'
+STREAM_WINDOW_SECONDS = 600   # default window of addplot_stream for sound data
+STREAM_WINDOW_ROWS = 1000000  # default window of addplot_stream for table data
+
+# GUI and IPython dependencies are imported on first use, so that importing this library stays cheap
+# and works on nodes where they are not installed
+def map_inspector(*args, **kwargs):
+    from map_inspector.map_inspector import map_inspector
+    return map_inspector(*args, **kwargs)
+
+def monitoring_scope(*args, **kwargs):
+    from monitoring_scope.monitoring_scope import monitoring_scope
+    return monitoring_scope(*args, **kwargs)
+
+def display(*args, **kwargs):
+    from IPython.display import display
+    return display(*args, **kwargs)
+
+def HTML(*args, **kwargs):
+    from IPython.display import HTML
+    return HTML(*args, **kwargs)
 
 def show_params():
     string = '''
@@ -33,10 +81,14 @@ def show_params():
       'reduce_factor': 1,  # reduce factor (rf): reduce the number of output records to 1/rf of the number of input records.
       'window_size':   1,  # window size of moving average
       
+      'parallel_segmentation': False, # set True to split a large CSV (or .csv.gz) into row chunks that are segmented in parallel. for sound data, multiple rawdata files are segmented concurrently
+      'parallel_segmentation_chunk_bytes': None, # chunk size for parallel_segmentation. default: file size / number of cores (64 MiB for .csv.gz)
+
       # available parameters for sound type data
       'high_pass_filter': None,    # high pass filter (Hz) to apply to sound type data
       'low_pass_filter':  None,    # low pass filter (Hz) to apply to sound type data
       'multi_filter_option': '',   # multipass (bandpass) filter by filter string (ex. ":300,4000:5000,6000:8000,20000:")
+      'multi_filter_in_process': False, # set True to apply multi_filter_option with NumPy instead of /usr/local/bin/filter
       'n_moving_average': 197,     # moving average window size when smoothing FFT spectrum (default: windowLength * 0.003). You should set this option to 1 to stop smoothing.
       'segment_overlap_ratio': 50, # overlap ratio (%) between successive segments
       
@@ -44,6 +96,8 @@ def show_params():
       'rawdata_type': '',                         # 'table' or 'sound'
       'working_dir': 'analysis',                  # working dir to store analysis results
       'type_weight': 'analysis/type_weight.csv',  # file path of type_weight.csv
+      'type_weight_sample': None,                 # set a number of rows (e.g. 100000) to make type_weight.csv from a sample of the rawdata instead of all rows. ambiguous columns are listed in options['type_weight_ambiguous']
+      'type_weight_sample_method': 'stride',      # (type_weight_sample) 'stride' (evenly spaced rows), 'head' (first rows) or 'reservoir' (uniform random rows, reads the whole file)
       'map_inspector':    True,                   # set False if you don't want to start map_inspector automatically
       'map_inspector_sharable': False,            # set True if you want to share your results on map_inspector
       'monitoring_scope': False,                  # set True if you want to start monitoring_scope automatically
@@ -55,6 +109,15 @@ def show_params():
       'status_mi': 'analysis/status.mi',          # data file name to store current mining status for basemap on map_inspector
       'add_status_mi': 'analysis/status-add.mi',  # data file name to store current mining status for basemap and addplots on map_inspector
       'status_ms': 'analysis/status.ms',          # data file name to store current mining status for basemap and addplots on monitoring_scope
+      'segment_cache': True,                      # set False if you don't want to reuse cached segments (stored under working_dir/.segment_cache)
+      'segment_cache_hash': False,                # set True if you want to identify rawdata by its content hash in addition to size and mtime
+      'segment_cache_size': 4294967296,           # max total size (bytes) of the segment cache. least recently used entries are evicted
+      'segment_format': 'csv',                    # set 'binary' to keep base_segment/add_segment as compact float32 .tseg files. CSV copies are made only while toorpia, map_inspector or monitoring_scope need them (toorpia's copy of base_segment is cached as .tseg.csv)
+      'profile': False,                           # set True to record time, CPU, peak RSS and I/O bytes per stage in working_dir/run_reports/*.json
+      'profile_hook': None,                       # function called with the metrics of each stage as it completes (profile=True)
+      'results_archive': False,                   # set True to append every addplot result (float32 coordinates and metadata) to working_dir/results_archive
+      'stream_pipeline': False,                   # set True if you want to pipe segments through filter into toorpia without intermediate files
+      'stream_tee': True,                         # (stream_pipeline) set False if you don't need a copy of the segments on disk. map_inspector, monitoring_scope and later addplots read it
 
       # test parameters regarding the distance calculation. following options are mutually exclusive. you can use only one of them.
       'disable_normalization': False,   # set True if you want to disable vector normalization proc. completely.
@@ -63,6 +126,14 @@ def show_params():
     '''.strip()
     print(string)
 
+def __fail(message):
+    # in a background job (create_basemap_job, addplot_job) failures raise job_error, so that the caller can handle them
+    job = background.current()
+    if job is not None:
+        job.fail(str(message))
+    print(message, file=sys.stderr)
+    sys.exit(1)
+
 def __check_rawdata_existence(options):
     if 'rawdata' not in options:
         raise Exception('rawdata is not specified')
@@ -164,6 +235,15 @@ def __make_option_str_for_sound(options):
     
     return option_str
 
+def __make_option_str_for_toorpia(options):
+    option_str = ''
+    if 'disable_normalization' in options and options['disable_normalization'] == True:
+        option_str = '-u'
+    elif 'only_angle' in options and options['only_angle'] == True:
+        option_str = '-d'
+
+    return option_str
+
 def __set_output_file_for_basemap(options):
     if 'base_segment' not in options:
         options['base_segment'] = options['working_dir'] + '/segments.csv'
@@ -195,10 +275,13 @@ def __check_basemap_existence(options):
         options['status_mi'] = options['working_dir'] + '/status.mi'
         
     for key in ['base_segment', 'base_xy']:
-        if not os.path.exists(options[key]):
-            raise FileNotFoundError(options[key])
-        if not os.access(options[key], os.R_OK):
-            raise PermissionError('File not readable: %s' % options[key])
+        path = options[key]
+        if key == 'base_segment' and not os.path.exists(path) and os.path.exists(segment_format.binary_path_of(path)):
+            path = segment_format.binary_path_of(path) # base_segment is stored in binary format
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+        if not os.access(path, os.R_OK):
+            raise PermissionError('File not readable: %s' % path)
 
 def __set_output_file_for_addplot(options):
     if 'add_segment' not in options:
@@ -217,6 +300,125 @@ def __set_output_file_for_addplot(options):
         if not os.path.exists(file):
             os.makedirs(os.path.dirname(file), exist_ok=True)
 
+def __make_segment(options, cmd_str, option_str, segment_file):
+    cache_key = None
+    if 'segment_cache' not in options or options['segment_cache'] == True:
+        cache_dir = segment_cache.cache_dir_of(options['working_dir'])
+        input_files = options['rawdata'].split()
+        if options['rawdata_type'] == 'table': # segments also depend on the contents of type_weight.csv
+            input_files.append(options['type_weight'])
+        content_hash = 'segment_cache_hash' in options and options['segment_cache_hash'] == True
+        cache_key = segment_cache.make_key(cmd_str, option_str, input_files, content_hash=content_hash)
+        with profiling.stage('segment_cache', outputs=[segment_file]):
+            cache_hit = segment_cache.fetch(cache_dir, cache_key, segment_file)
+        if cache_hit:
+            return
+
+    parallel = 'parallel_segmentation' in options and options['parallel_segmentation'] == True
+    rawdata_files = options['rawdata'].split()
+    if parallel and options['rawdata_type'] == 'table' and len(rawdata_files) == 1:
+        try:
+            with profiling.stage(cmd_str, inputs=rawdata_files, outputs=[segment_file]):
+                parallel_segment.make_segments(cmd_str, option_str, options['rawdata'], segment_file, options['working_dir'],
+                                               window_size=options.get('window_size', 1), reduce_factor=options.get('reduce_factor', 1),
+                                               chunk_bytes=options.get('parallel_segmentation_chunk_bytes'))
+        except RuntimeError as e:
+            __fail(e)
+    elif parallel and options['rawdata_type'] == 'sound' and len(rawdata_files) > 1:
+        try:
+            with profiling.stage(cmd_str, inputs=rawdata_files, outputs=[segment_file]):
+                parallel_segment.make_segments_per_file(cmd_str, option_str, rawdata_files, segment_file, options['working_dir'])
+        except RuntimeError as e:
+            __fail(e)
+    else:
+        segment_log = segment_file + '.log'
+        returncode = profiling.run(cmd_str, f"{cmd_str} {option_str} {options['rawdata']} 2> {segment_log} > {segment_file}", inputs=rawdata_files, outputs=[segment_file])
+        if returncode != 0:
+            __fail(f"{cmd_str} command failed. see {segment_log}")
+
+    if cache_key is not None:
+        max_bytes = options.get('segment_cache_size', segment_cache.DEFAULT_MAX_BYTES)
+        segment_cache.store(cache_dir, cache_key, segment_file, max_bytes=max_bytes)
+
+def __use_binary_segment(options):
+    return 'segment_format' in options and options['segment_format'] == 'binary'
+
+def __store_segment(options, segment_file, keep_csv):
+    # with segment_format 'binary', convert segment_file to .tseg and drop the CSV unless it is still needed
+    binary_file = segment_format.binary_path_of(segment_file)
+    if not os.path.exists(segment_file): # e.g. stream_pipeline without stream_tee
+        return
+    if os.path.exists(__segment_csv_cache_of(segment_file)):
+        os.remove(__segment_csv_cache_of(segment_file))
+    if __use_binary_segment(options):
+        with profiling.stage('segment_format', inputs=[segment_file], outputs=[binary_file]):
+            segment_format.csv_to_binary(segment_file, binary_file)
+        if not keep_csv:
+            os.remove(segment_file)
+    elif os.path.exists(binary_file): # do not leave a stale binary copy behind
+        os.remove(binary_file)
+
+def __segment_csv_cache_of(segment_file):
+    return segment_format.binary_path_of(segment_file) + '.csv'
+
+def __segment_csv_of(segment_file, keep_csv):
+    # returns a CSV path for segment_file. a segment stored only in binary format is converted back to CSV for toorpia,
+    # map_inspector and monitoring_scope: into segment_file with keep_csv, otherwise into a cache next to the .tseg that
+    # is reused as long as its mtime is the one of the .tseg (every job of addplot_batch, addplot_stream and
+    # addplot_multi projects onto the same base segments)
+    binary_file = segment_format.binary_path_of(segment_file)
+    if os.path.exists(segment_file) or not os.path.exists(binary_file):
+        return segment_file
+    mtime = os.stat(binary_file).st_mtime_ns
+    csv_file = segment_file if keep_csv else __segment_csv_cache_of(segment_file)
+    if not keep_csv and os.path.exists(csv_file) and os.stat(csv_file).st_mtime_ns == mtime:
+        return csv_file
+    tmp_file = '%s.tmp-%d-%d' % (csv_file, os.getpid(), threading.get_ident())
+    with profiling.stage('segment_format', inputs=[binary_file], outputs=[csv_file]):
+        segment_format.binary_to_csv(binary_file, tmp_file)
+    os.utime(tmp_file, ns=(mtime, mtime))
+    os.replace(tmp_file, csv_file) # atomic, so that concurrent jobs never read a partial cache
+    return csv_file
+
+def __run_streaming_pipeline(options, cmd_str, option_str, toorpia_cmd, segment_file, xy_file):
+    # connect segmentation, filter and toorpia with OS pipes so that segments never make a round trip through the disk.
+    # a copy of the (filtered) segments is written to segment_file by tee unless stream_tee is False. without it,
+    # segment_file of an earlier run is removed, so that it is never taken for the segments of this one
+    tee = 'stream_tee' not in options or options['stream_tee'] == True
+    if not tee:
+        for file in [segment_file, segment_format.binary_path_of(segment_file)]:
+            if os.path.exists(file):
+                os.remove(file)
+    stages = [(cmd_str, f"{cmd_str} {option_str} {options['rawdata']}", segment_file + '.log')]
+    if options['rawdata_type'] == 'sound' and 'multi_filter_option' in options:
+        filter_cmd = FILTER_CMD
+        stages.append((filter_cmd, f"{filter_cmd} -f {options['multi_filter_option']} --sr {options['sampling_rate']} /dev/stdin", segment_file + '.filter.log'))
+    if tee:
+        stages.append(('tee', f"tee {segment_file}", segment_file + '.tee.log'))
+    stages.append(('toorpia', f"{toorpia_cmd} /dev/stdin", xy_file + '.log'))
+
+    procs = []
+    upstream = None
+    start = time.perf_counter()
+    with open(xy_file, 'w') as xy:
+        for i, (name, cmd, log) in enumerate(stages):
+            downstream = xy if i == len(stages) - 1 else subprocess.PIPE
+            job_stage = background.stage_started(name)
+            with open(log, 'w') as err:
+                proc = background.popen(cmd, stdin=upstream, stdout=downstream, stderr=err)
+            if upstream is not None:
+                upstream.close() # so that the upstream stage gets SIGPIPE if this stage exits early
+            upstream = proc.stdout
+            procs.append((name, log, proc, job_stage))
+        for i, (name, _, proc, job_stage) in enumerate(procs):
+            inputs = options['rawdata'].split() if i == 0 else []
+            outputs = [xy_file] if i == len(procs) - 1 else ([segment_file] if name == 'tee' else [])
+            profiling.wait(proc, name, start, inputs=inputs, outputs=outputs, job_stage=job_stage)
+
+    for name, log, proc, _ in procs:
+        if proc.returncode != 0:
+            __fail(f"{name} command failed. see {log}")
+
 def create_type_weight(options):
     __check_rawdata_existence(options)
     __check_working_dir(options)
@@ -232,14 +434,29 @@ def create_type_weight(options):
         raise Exception('rawdata_type is sound, so type_weight is not needed')
     
 
+    # with type_weight_sample, mkcsvseg reads a bounded sample of the rows instead of the whole rawdata
+    rawdata = options['rawdata']
+    sample_file = None
+    if 'type_weight_sample' in options and options['type_weight_sample'] not in (None, 0, False):
+        method = options['type_weight_sample_method'] if 'type_weight_sample_method' in options else 'stride'
+        header, rows = table_sample.sample_rows(options['rawdata'].split(), int(options['type_weight_sample']), method)
+        sample_file = table_sample.write_sample(os.path.join(options['working_dir'], 'type_weight_sample.csv'), header, rows)
+        rawdata = sample_file
+        options['type_weight_ambiguous'] = table_sample.ambiguous_columns(header, rows)
+
     type_weight_log = options['type_weight'] + '.log'
-    rv = subprocess.run(f"mkcsvseg -o {options['type_weight']} {options['rawdata']} 1> /dev/null 2> {type_weight_log}", shell=True)
+    rv = subprocess.run(f"mkcsvseg -o {options['type_weight']} {rawdata} 1> /dev/null 2> {type_weight_log}", shell=True)
+    if sample_file is not None:
+        os.remove(sample_file)
     if rv.returncode != 0:
-        print(f"mkcsvseg command failed. see {type_weight_log}", file=sys.stderr)
-        sys.exit(1)
+        __fail(f"mkcsvseg command failed. see {type_weight_log}")
 
     display(HTML(f"<p>Click link <a href='{options['type_weight']}'>{options['type_weight']}</a> to edit and save it.</p>"))
+    if sample_file is not None and len(options['type_weight_ambiguous']) > 0:
+        items = ''.join(f"<li>{name}: {reason}</li>" for name, reason in options['type_weight_ambiguous'].items())
+        display(HTML(f"<p>type_weight was made from a sample of {len(rows)} rows. check these columns:</p><ul>{items}</ul>"))
 
+@profiling.profiled('create_basemap')
 def create_basemap(options):
     __check_rawdata_existence(options)
     __check_rawdata_type(options)
@@ -255,26 +472,24 @@ def create_basemap(options):
 
     __set_output_file_for_basemap(options)
 
-    base_segment_log = options['base_segment'] + '.log'
-    rv = subprocess.run(f"{cmd_str} {option_str} {options['rawdata']} 2> {base_segment_log} > {options['base_segment']}", shell=True)
-    if rv.returncode != 0:
-        print(f"{cmd_str} command failed. see {base_segment_log}", file=sys.stderr)
-        sys.exit(1)
-    
-    if options['rawdata_type'] == 'sound' and 'multi_filter_option' in options:
-        multi_filter(options)
+    option_str_toorpia = __make_option_str_for_toorpia(options)
 
-    option_str_toorpia = ''
-    if 'disable_normalization' in options and options['disable_normalization'] == True:
-        option_str_toorpia = '-u'
-    elif 'only_angle' in options and options['only_angle'] == True:
-        option_str_toorpia = '-d'
+    if 'stream_pipeline' in options and options['stream_pipeline'] == True:
+        if 'stream_tee' in options and options['stream_tee'] == False and not ('map_inspector' in options and options['map_inspector'] == False):
+            raise Exception('map_inspector needs base_segment. set stream_tee True or map_inspector False')
+        __run_streaming_pipeline(options, cmd_str, option_str, f"toorpia -m base {option_str_toorpia}", options['base_segment'], options['base_xy'])
+    else:
+        __make_segment(options, cmd_str, option_str, options['base_segment'])
 
-    base_xy_log = options['base_xy'] + '.log'
-    rv = subprocess.run(f"toorpia -m base {option_str_toorpia} {options['base_segment']} 2> {base_xy_log} > {options['base_xy']}", shell=True)
-    if rv.returncode != 0:
-        print(f"toorpia command failed. see {base_xy_log}", file=sys.stderr)
-        sys.exit(1)
+        if options['rawdata_type'] == 'sound' and 'multi_filter_option' in options:
+            multi_filter(options)
+
+        base_xy_log = options['base_xy'] + '.log'
+        returncode = profiling.run('toorpia', f"toorpia -m base {option_str_toorpia} {options['base_segment']} 2> {base_xy_log} > {options['base_xy']}", inputs=[options['base_segment']], outputs=[options['base_xy']])
+        if returncode != 0:
+            __fail(f"toorpia command failed. see {base_xy_log}")
+
+    __store_segment(options, options['base_segment'], keep_csv=not ('map_inspector' in options and options['map_inspector'] == False))
 
     if 'map_inspector' in options and options['map_inspector'] == False:
         None
@@ -287,20 +502,17 @@ def create_basemap(options):
             option_rawcsv_str = None
 
         if 'map_inspector_sharable' in options and options['map_inspector_sharable'] == True:
-            map_inspector(options['base_segment'], options['base_xy'], options['status_mi'], sharable=True, working_dir=options['working_dir'], rawcsv=option_rawcsv_str)
+            with profiling.stage('map_inspector'):
+                map_inspector(options['base_segment'], options['base_xy'], options['status_mi'], sharable=True, working_dir=options['working_dir'], rawcsv=option_rawcsv_str)
         else:
             options['map_inspector_sharable'] = False
-            map_inspector(options['base_segment'], options['base_xy'], options['status_mi'], working_dir=options['working_dir'], rawcsv=option_rawcsv_str)
+            with profiling.stage('map_inspector'):
+                map_inspector(options['base_segment'], options['base_xy'], options['status_mi'], working_dir=options['working_dir'], rawcsv=option_rawcsv_str)
     
-    x = []
-    y = []
-    with open(options['base_xy'], "r") as f:
-        for line in f:
-            coord = line.rstrip().split()
-            x.append(float(coord[0]))
-            y.append(float(coord[1]))
-    return numpy.array(x), numpy.array(y)
+    with profiling.stage('load_xy', inputs=[options['base_xy']]):
+        return load_xy(options['base_xy'])
 
+@profiling.profiled('open_basemap')
 def open_basemap(options):
     __check_basemap_existence(options)
 
@@ -308,6 +520,7 @@ def open_basemap(options):
         None
     else:
         options['map_inspector'] = True
+        __segment_csv_of(options['base_segment'], keep_csv=True)
 
         if len(options['rawdata'].split()) == 1:
             option_rawcsv_str = options['rawdata']
@@ -315,20 +528,17 @@ def open_basemap(options):
             option_rawcsv_str = None
 
         if 'map_inspector_sharable' in options and options['map_inspector_sharable'] == True:
-            map_inspector(options['base_segment'], options['base_xy'], options['status_mi'], sharable=True, working_dir=options['working_dir'], rawcsv=option_rawcsv_str)
+            with profiling.stage('map_inspector'):
+                map_inspector(options['base_segment'], options['base_xy'], options['status_mi'], sharable=True, working_dir=options['working_dir'], rawcsv=option_rawcsv_str)
         else:
             options['map_inspector_sharable'] = False
-            map_inspector(options['base_segment'], options['base_xy'], options['status_mi'], working_dir=options['working_dir'], rawcsv=option_rawcsv_str)
+            with profiling.stage('map_inspector'):
+                map_inspector(options['base_segment'], options['base_xy'], options['status_mi'], working_dir=options['working_dir'], rawcsv=option_rawcsv_str)
     
-    x = []
-    y = []
-    with open(options['base_xy'], "r") as f:
-        for line in f:
-            coord = line.rstrip().split()
-            x.append(float(coord[0]))
-            y.append(float(coord[1]))
-    return numpy.array(x), numpy.array(y)
+    with profiling.stage('load_xy', inputs=[options['base_xy']]):
+        return load_xy(options['base_xy'])
 
+@profiling.profiled('addplot')
 def addplot(options):
     __check_rawdata_existence(options)
     __check_rawdata_type(options)
@@ -345,56 +555,421 @@ def addplot(options):
     __check_basemap_existence(options)
     __set_output_file_for_addplot(options)
 
-    add_segment_log = options['add_segment'] + '.log'
-    rv = subprocess.run(f"{cmd_str} {option_str} {options['rawdata']} 2> {add_segment_log} > {options['add_segment']}", shell=True)
-    if rv.returncode != 0:
-        print(f"{cmd_str} command failed. see {add_segment_log}", file=sys.stderr)
-        sys.exit(1)
+    map_inspector_enabled = not ('map_inspector' in options and options['map_inspector'] == False)
+    monitoring_scope_enabled = 'monitoring_scope' in options and options['monitoring_scope'] == True
+    base_segment_csv = __segment_csv_of(options['base_segment'], keep_csv=map_inspector_enabled)
 
-    if options['rawdata_type'] == 'sound' and 'multi_filter_option' in options:
-        multi_filter_add(options)
+    option_str_toorpia = __make_option_str_for_toorpia(options)
 
-    option_str_toorpia = ''
-    if 'disable_normalization' in options and options['disable_normalization'] == True:
-        option_str_toorpia = '-u'
-    elif 'only_angle' in options and options['only_angle'] == True:
-        option_str_toorpia = '-d'
+    if 'stream_pipeline' in options and options['stream_pipeline'] == True:
+        if 'stream_tee' in options and options['stream_tee'] == False and monitoring_scope_enabled:
+            raise Exception('monitoring_scope needs add_segment. set stream_tee True or monitoring_scope False')
+        __run_streaming_pipeline(options, cmd_str, option_str, f"toorpia -m add {option_str_toorpia} {base_segment_csv} {options['base_xy']}", options['add_segment'], options['add_xy'])
+    else:
+        __make_segment(options, cmd_str, option_str, options['add_segment'])
 
-    add_xy_log = options['add_xy'] + '.log'
-    rv = subprocess.run(f"toorpia -m add {option_str_toorpia} {options['base_segment']} {options['base_xy']} {options['add_segment']} 2> {add_xy_log} > {options['add_xy']}", shell=True)
-    if rv.returncode != 0:
-        print(f"toorpia command failed. see {add_xy_log}", file=sys.stderr)
-        sys.exit(1)
+        if options['rawdata_type'] == 'sound' and 'multi_filter_option' in options:
+            multi_filter_add(options)
+
+        add_xy_log = options['add_xy'] + '.log'
+        returncode = profiling.run('toorpia', f"toorpia -m add {option_str_toorpia} {base_segment_csv} {options['base_xy']} {options['add_segment']} 2> {add_xy_log} > {options['add_xy']}", inputs=[base_segment_csv, options['base_xy'], options['add_segment']], outputs=[options['add_xy']])
+        if returncode != 0:
+            __fail(f"toorpia command failed. see {add_xy_log}")
+
+    __store_segment(options, options['add_segment'], keep_csv=monitoring_scope_enabled)
     
     if 'map_inspector' in options and options['map_inspector'] == False:
         None
     else:
         options['map_inspector'] = True
         if 'map_inspector_sharable' in options and options['map_inspector_sharable'] == True:
-            map_inspector(options['base_segment'], options['base_xy'], options['add_status_mi'], addplot=options['add_xy'], sharable=True, working_dir=options['working_dir'])
+            with profiling.stage('map_inspector'):
+                map_inspector(options['base_segment'], options['base_xy'], options['add_status_mi'], addplot=options['add_xy'], sharable=True, working_dir=options['working_dir'])
         else:
             options['map_inspector_sharable'] = False
-            map_inspector(options['base_segment'], options['base_xy'], options['add_status_mi'], addplot=options['add_xy'], sharable=False, working_dir=options['working_dir'])
+            with profiling.stage('map_inspector'):
+                map_inspector(options['base_segment'], options['base_xy'], options['add_status_mi'], addplot=options['add_xy'], sharable=False, working_dir=options['working_dir'])
 
     if 'monitoring_scope' in options and options['monitoring_scope'] == True:
         if 'monitoring_scope_sharable' in options and options['monitoring_scope_sharable'] == True:
-            monitoring_scope(options['base_xy'], options['add_segment'], options['add_xy'], options['status_ms'], sharable=True)
+            with profiling.stage('monitoring_scope'):
+                monitoring_scope(options['base_xy'], options['add_segment'], options['add_xy'], options['status_ms'], sharable=True)
         else:
             options['monitoring_scope_sharable'] = False
-            monitoring_scope(options['base_xy'], options['add_segment'], options['add_xy'], options['status_ms'], sharable=False)
+            with profiling.stage('monitoring_scope'):
+                monitoring_scope(options['base_xy'], options['add_segment'], options['add_xy'], options['status_ms'], sharable=False)
     else:
         options['monitoring_scope'] = False
         options['monitoring_scope_sharable'] = False
 
-    x = []
-    y = []
-    with open(options['add_xy'], "r") as f:
-        for line in f:
-            coord = line.rstrip().split()
-            x.append(float(coord[0]))
-            y.append(float(coord[1]))
+    with profiling.stage('load_xy', inputs=[options['add_xy']]):
+        x, y = load_xy(options['add_xy'])
+
+    if 'results_archive' in options and options['results_archive'] == True:
+        with profiling.stage('results_archive', inputs=[options['add_xy']]):
+            results_archive.open_archive(options['working_dir']).append(x, y, options['rawdata'], options, options['base_xy'])
     return x, y
 
+def open_basemap_index(options):
+    # grid index over base_xy, saved as base_xy + '.grid.npz' and rebuilt only when base_xy changes.
+    #   index = open_basemap_index(params)
+    #   distances, indices = index.knn(x_add, y_add, k=5)   # nearest basemap points of every addplot point
+    #   counts = index.radius_count(x_add, y_add, 0.5)      # basemap points within the radius
+    #   regions = index.region_labels(x_add, y_add, labels) # labels: one per basemap point, in base_xy order
+    if 'working_dir' not in options:
+        options['working_dir'] = 'analysis'
+    if 'base_xy' not in options:
+        options['base_xy'] = options['working_dir'] + '/xy.dat'
+    if not os.path.exists(options['base_xy']):
+        raise FileNotFoundError(options['base_xy'])
+    return spatial_index.open_index(options['base_xy'])
+
+def open_results_archive(options):
+    # addplot results archived with results_archive=True, newest last.
+    #   archive = open_results_archive(params)
+    #   entries = archive.entries(rawdata='day1.wav', basemap=params['base_xy'], since=time.time() - 30 * 86400)
+    #   x, y = archive.load(entries[-1])   # memory-mapped, no recomputation
+    if 'working_dir' not in options:
+        options['working_dir'] = 'analysis'
+    return results_archive.open_archive(options['working_dir'])
+
+def create_basemap_job(options):
+    # start create_basemap in the background and return its job right away. the notebook stays responsive and
+    # several jobs (with different working_dir) can run at once.
+    #   job.progress(), job.status(), job.cancel(), job.result(timeout=None) -> (x, y), raises job_error
+    return background.start('create_basemap', create_basemap, options)
+
+def addplot_job(options):
+    # addplot counterpart of create_basemap_job
+    return background.start('addplot', addplot, options)
+
+def addplot_batch(options, rawdata_list, max_workers=None):
+    # run addplot for each rawdata file in a worker pool and yield (rawdata, x, y) as each job completes.
+    # each job writes its own segments and coordinates under working_dir/addplot_batch/.
+    # segmentation and toorpia run as child processes, so threads are enough to keep all cores busy.
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+
+    __check_working_dir(options)
+    __check_basemap_existence(options)
+
+    jobs = []
+    for i, rawdata in enumerate(rawdata_list):
+        job_dir = os.path.join(options['working_dir'], 'addplot_batch', '%04d-%s' % (i, os.path.basename(rawdata)))
+        job_options = dict(options)
+        job_options['rawdata'] = rawdata
+        job_options['add_segment'] = job_dir + '/segments-add.csv'
+        job_options['add_xy'] = job_dir + '/xy-add.dat'
+        job_options['add_status_mi'] = job_dir + '/status-add.mi'
+        job_options['status_ms'] = job_dir + '/status.ms'
+        job_options['map_inspector'] = False
+        job_options['monitoring_scope'] = False
+        jobs.append(job_options)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(addplot, job_options): job_options['rawdata'] for job_options in jobs}
+        for future in as_completed(futures):
+            x, y = future.result()
+            yield futures[future], x, y
+
+def __project_onto_basemap(options):
+    # toorpia -m add of options['add_segment'] onto the basemap of options. runs in a worker thread of addplot_multi
+    base_segment_csv = __segment_csv_of(options['base_segment'], keep_csv=False)
+    add_xy_log = options['add_xy'] + '.log'
+    returncode = background.popen(f"toorpia -m add {__make_option_str_for_toorpia(options)} {base_segment_csv} {options['base_xy']} {options['add_segment']} 2> {add_xy_log} > {options['add_xy']}").wait()
+    if returncode != 0:
+        raise RuntimeError(f"toorpia command failed. see {add_xy_log}")
+    return options['add_xy']
+
+@profiling.profiled('addplot_multi')
+def addplot_multi(options, basemaps, max_workers=None):
+    # addplot one rawdata to several basemaps: the rawdata is segmented once (add_segment) and toorpia -m add runs
+    # for all basemaps in parallel. basemaps: list of (base_segment, base_xy), optionally with a dict of options for
+    # that basemap as third item (e.g. {'disable_normalization': True}). returns [(x, y), ...] in the order of basemaps.
+    # the coordinates of each basemap are written to working_dir/addplot_multi/<n>-<base_xy name>/xy-add.dat.
+    # map_inspector and monitoring_scope are not started.
+    __check_rawdata_existence(options)
+    __check_rawdata_type(options)
+
+    if options['rawdata_type'] == 'table':
+        __check_required_options_for_table(options)
+        cmd_str = 'mkcsvseg'
+        option_str = __make_option_str_for_table(options)
+    elif options['rawdata_type'] == 'sound':
+        __check_required_options_for_sound(options)
+        cmd_str = 'mkfftseg'
+        option_str = __make_option_str_for_sound(options)
+    __set_output_file_for_addplot(options)
+
+    jobs = []
+    for i, basemap in enumerate(basemaps):
+        job_options = dict(options)
+        job_options['base_segment'] = basemap[0]
+        job_options['base_xy'] = basemap[1]
+        if len(basemap) > 2:
+            job_options.update(basemap[2])
+        __check_basemap_existence(job_options)
+        job_dir = os.path.join(options['working_dir'], 'addplot_multi', '%04d-%s' % (i, os.path.basename(job_options['base_xy'])))
+        os.makedirs(job_dir, exist_ok=True)
+        job_options['add_xy'] = job_dir + '/xy-add.dat'
+        jobs.append(job_options)
+    if len(jobs) == 0:
+        return []
+    if max_workers is None:
+        max_workers = min(len(jobs), os.cpu_count() or 1)
+
+    __make_segment(options, cmd_str, option_str, options['add_segment'])
+    if options['rawdata_type'] == 'sound' and 'multi_filter_option' in options:
+        multi_filter_add(options)
+
+    # toorpia runs as child processes, so threads are enough to keep all cores busy
+    with profiling.stage('toorpia', inputs=[options['add_segment']], outputs=[job_options['add_xy'] for job_options in jobs]):
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [background.submit(executor, __project_onto_basemap, job_options) for job_options in jobs]
+            for future in futures:
+                try:
+                    future.result()
+                except RuntimeError as e:
+                    __fail(e)
+    __store_segment(options, options['add_segment'], keep_csv=False)
+
+    results = []
+    for job_options in jobs:
+        with profiling.stage('load_xy', inputs=[job_options['add_xy']]):
+            x, y = load_xy(job_options['add_xy'])
+        if 'results_archive' in options and options['results_archive'] == True:
+            with profiling.stage('results_archive', inputs=[job_options['add_xy']]):
+                results_archive.open_archive(options['working_dir']).append(x, y, options['rawdata'], job_options, job_options['base_xy'])
+        results.append((x, y))
+    return results
+
+def addplot_stream(options, window=None, start=None, end=None):
+    # addplot one long rawdata file (e.g. a days-long .wav.gz) window by window and yield (x, y) for each window, in
+    # order, so that memory stays flat whatever the length of the recording. window, start and end are seconds for
+    # sound data and rows for table data. only [start, end) is decoded, e.g. one hour of a long recording:
+    #   for x, y in addplot_stream(params, start=3600, end=7200): ...
+    # the windows are segmented and projected under working_dir and removed again: add_segment and add_xy are not
+    # written, and map_inspector / monitoring_scope are not started. the coordinates are the same as those of one
+    # addplot over [start, end) (see rawdata_window for how the windows overlap).
+    __check_rawdata_existence(options)
+    __check_rawdata_type(options)
+    if len(options['rawdata'].split()) != 1:
+        raise Exception('addplot_stream takes one rawdata file: %s' % options['rawdata'])
+
+    rawdata = options['rawdata']
+    if options['rawdata_type'] == 'table':
+        __check_required_options_for_table(options)
+        cmd_str = 'mkcsvseg'
+        option_str = __make_option_str_for_table(options)
+    else:
+        __check_required_options_for_sound(options)
+        cmd_str = 'mkfftseg'
+        option_str = __make_option_str_for_sound(options)
+    __check_basemap_existence(options)
+
+    stream_dir = tempfile.mkdtemp(prefix='stream-', dir=options['working_dir'])
+    job_options = dict(options)
+    job_options['add_segment'] = os.path.join(stream_dir, 'segments-window.csv')
+    job_options['add_xy'] = os.path.join(stream_dir, 'xy-window.dat')
+    job_options['add_status_mi'] = os.path.join(stream_dir, 'status-window.mi')
+    job_options['map_inspector'] = False
+    job_options['monitoring_scope'] = False
+    job_options['segment_cache'] = False # windows are never segmented twice
+    job_options['segment_format'] = 'csv'
+    job_options['parallel_segmentation'] = False
+    job_options['profile'] = False # one report per window would not be useful
+    job_options['results_archive'] = False # windows are not results on their own
+
+    try:
+        if options['rawdata_type'] == 'table':
+            reduce_factor = max(int(options.get('reduce_factor', 1)), 1)
+            window_rows = max(-(-int(window or STREAM_WINDOW_ROWS) // reduce_factor), 1) * reduce_factor
+            start_row = int(start or 0) // reduce_factor * reduce_factor # decimation stays aligned with the whole file
+            n_context = parallel_segment.context_rows(options.get('window_size', 1), reduce_factor)
+            windows = rawdata_window.csv_windows(rawdata, stream_dir, window_rows, carry=n_context, start=start_row,
+                                                 end=None if end is None else int(end), context=True)
+        else:
+            if re.match(r'^.*\.wav(\.gz)?$', rawdata, re.IGNORECASE):
+                sampling_rate = rawdata_window.wav_framerate(rawdata)
+            else:
+                sampling_rate = float(options['sampling_rate'])
+            window_frames, carry = rawdata_window.sound_windows(options['window_length'], options.get('segment_overlap_ratio', 50),
+                                                                (window or STREAM_WINDOW_SECONDS) * sampling_rate)
+            start_frame = int(round((start or 0) * sampling_rate))
+            end_frame = None if end is None else int(round(end * sampling_rate))
+            if re.match(r'^.*\.wav(\.gz)?$', rawdata, re.IGNORECASE):
+                windows = ((position, window_file, 0) for position, window_file in
+                           rawdata_window.wav_windows(rawdata, stream_dir, window_frames, carry, start_frame, end_frame, min_frames=int(options['window_length'])))
+            else:
+                windows = rawdata_window.csv_windows(rawdata, stream_dir, window_frames, carry=carry, start=start_frame, end=end_frame,
+                                                     min_rows=int(options['window_length']))
+
+        n_drop = {} # segments of the context rows, by number of context rows
+        for position, window_file, n_context in windows:
+            if n_context > 0 and n_context not in n_drop:
+                try:
+                    n_drop[n_context] = parallel_segment.context_segments(cmd_str, option_str, window_file, n_context, stream_dir)
+                except RuntimeError as e:
+                    __fail(e)
+            job_options['rawdata'] = window_file
+            x, y = addplot(job_options)
+            drop = n_drop.get(n_context, 0)
+            yield numpy.array(x[drop:]), numpy.array(y[drop:])
+    finally:
+        shutil.rmtree(stream_dir, ignore_errors=True)
+
+def __append_file(src, dest, skip_header=False, skip_rows=0):
+    # append src to dest. with skip_header, the first line of src is dropped if it is a header that dest already
+    # starts with. the first skip_rows data rows of src (e.g. segments of context rows) are dropped
+    with open(src, 'rb') as fin:
+        first_line = fin.readline()
+        if segment_format.is_header_line(first_line):
+            if skip_header and os.path.exists(dest) and os.path.getsize(dest) > 0:
+                with open(dest, 'rb') as f:
+                    if f.readline() == first_line:
+                        first_line = b''
+        elif skip_rows > 0:
+            first_line = b''
+            skip_rows -= 1
+        for _ in range(skip_rows):
+            fin.readline()
+        with open(dest, 'ab') as fout:
+            fout.write(first_line)
+            shutil.copyfileobj(fin, fout)
+
+def __save_watch_state(state_file, state):
+    tmp = state_file + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp, state_file)
+
+def __prepare_watch_increment(options, path, entry, increment_csv):
+    # returns (rawdata to addplot, context rows in it, new state entry) for what is new in path since entry, or
+    # (None, 0, entry) if nothing is.
+    # plain table CSVs may grow: their complete rows appended since the last increment are plotted (with the header),
+    # a multiple of reduce_factor at a time so that decimation stays aligned with the whole file. they are preceded by
+    # the context rows for the moving average (see parallel_segment), whose segments the caller drops.
+    # other files are plotted once, when their size has settled. later changes to them are not plotted.
+    file_options = dict(options)
+    file_options['rawdata'] = path
+    __check_rawdata_type(file_options)
+    size = os.path.getsize(path)
+
+    if file_options['rawdata_type'] == 'table' and re.match(r'^.*\.csv$', path, re.IGNORECASE):
+        reduce_factor = max(int(file_options.get('reduce_factor', 1)), 1)
+        n_context = parallel_segment.context_rows(file_options.get('window_size', 1), reduce_factor)
+        offset = 0 if entry is None else entry['offset']
+        context_offset = offset if entry is None else entry.get('context_offset', offset)
+        with open(path, 'rb') as f:
+            header = f.readline()
+            if offset == 0:
+                offset = context_offset = f.tell()
+            f.seek(context_offset)
+            rows = f.read(size - context_offset)
+        n_carried = rows.count(b'\n', 0, offset - context_offset)
+        end = rows.rfind(b'\n') + 1 # only complete rows
+        n_new = rows.count(b'\n', offset - context_offset, end)
+        if n_new < reduce_factor:
+            return None, 0, entry
+        for _ in range(n_new % reduce_factor): # the rest waits for the next increment
+            end = rows.rfind(b'\n', 0, end - 1) + 1
+        # the last n_context rows are the context of the next increment
+        context_start = end
+        for _ in range(min(n_context, n_carried + n_new - n_new % reduce_factor)):
+            context_start = rows.rfind(b'\n', 0, context_start - 1) + 1
+        with open(increment_csv, 'wb') as f:
+            f.write(header)
+            f.write(rows[:end])
+        return increment_csv, n_carried, {'offset': context_offset + end, 'context_offset': context_offset + context_start, 'size': size}
+
+    if entry is not None and entry['offset'] > 0: # plotted already. its points are never appended a second time
+        if entry['size'] != size:
+            print("%s changed after it was plotted. the change is not plotted" % path, file=sys.stderr)
+            entry = dict(entry, size=size)
+        return None, 0, entry
+    if entry is not None and entry['offset'] >= size: # empty
+        return None, 0, entry
+    if entry is None or entry['size'] != size: # still being written. look again at the next poll
+        return None, 0, {'offset': 0, 'size': size}
+    return path, 0, {'offset': size, 'size': size}
+
+def watch_addplot(options, watch_dir, interval=5.0, max_polls=None):
+    # poll watch_dir and addplot what is new: new rawdata files and rows appended to table CSVs.
+    # each increment is segmented and projected on its own, so latency stays constant as history grows, and its
+    # segments and coordinates are appended to add_segment and add_xy. yields (rawdata, x, y) for every increment.
+    # the progress is kept in working_dir/watch/state.json, so a restarted watcher resumes where it stopped.
+    # increments of a growing CSV carry the rows that moving average (window_size) and decimation (reduce_factor)
+    # need, so their segments are those of one run over the whole file.
+    __check_working_dir(options)
+    __check_basemap_existence(options)
+    __set_output_file_for_addplot(options)
+
+    watch_work_dir = os.path.join(options['working_dir'], 'watch')
+    os.makedirs(watch_work_dir, exist_ok=True)
+    state_file = os.path.join(watch_work_dir, 'state.json')
+    if os.path.exists(state_file):
+        with open(state_file, 'r') as f:
+            state = json.load(f)
+    else: # fresh start: add_segment and add_xy are rebuilt from the increments
+        state = {}
+        for file in [options['add_segment'], options['add_xy']]:
+            if os.path.exists(file):
+                os.remove(file)
+
+    rawdata_regExp = re.compile(r'^.*\.(wav|csv)(\.gz)?$', re.IGNORECASE)
+    monitoring_scope_started = False
+    n_drop = {} # segments of the context rows, by number of context rows
+    polls = 0
+    while max_polls is None or polls < max_polls:
+        polls += 1
+        for name in sorted(os.listdir(watch_dir)):
+            path = os.path.abspath(os.path.join(watch_dir, name))
+            if not re.match(rawdata_regExp, name) or not os.path.isfile(path):
+                continue
+
+            rawdata, n_context, state[path] = __prepare_watch_increment(options, path, state.get(path), os.path.join(watch_work_dir, 'increment.csv'))
+            if rawdata is None:
+                continue
+
+            job_options = dict(options)
+            job_options['rawdata'] = rawdata
+            job_options['add_segment'] = os.path.join(watch_work_dir, 'segments-increment.csv')
+            job_options['add_xy'] = os.path.join(watch_work_dir, 'xy-increment.dat')
+            job_options['add_status_mi'] = os.path.join(watch_work_dir, 'status-increment.mi')
+            job_options['map_inspector'] = False
+            job_options['monitoring_scope'] = False
+            job_options['segment_cache'] = False # increments are never segmented twice
+            job_options['segment_format'] = 'csv' # increments are appended to add_segment as CSV
+            x, y = addplot(job_options)
+            if n_context > 0 and n_context not in n_drop:
+                try:
+                    n_drop[n_context] = parallel_segment.context_segments('mkcsvseg', __make_option_str_for_table(job_options), rawdata, n_context, watch_work_dir)
+                except RuntimeError as e:
+                    __fail(e)
+            drop = n_drop.get(n_context, 0)
+            x, y = numpy.array(x[drop:]), numpy.array(y[drop:])
+
+            __append_file(job_options['add_segment'], options['add_segment'], skip_header=True, skip_rows=drop)
+            __append_file(job_options['add_xy'], options['add_xy'], skip_rows=drop)
+            __save_watch_state(state_file, state)
+
+            # monitoring_scope is started once, on the growing add_segment and add_xy
+            if 'monitoring_scope' in options and options['monitoring_scope'] == True and not monitoring_scope_started:
+                sharable = 'monitoring_scope_sharable' in options and options['monitoring_scope_sharable'] == True
+                with profiling.stage('monitoring_scope'):
+                    monitoring_scope(options['base_xy'], options['add_segment'], options['add_xy'], options['status_ms'], sharable=sharable)
+                monitoring_scope_started = True
+
+            yield path, x, y
+
+        __save_watch_state(state_file, state)
+        if max_polls is None or polls < max_polls:
+            time.sleep(interval)
+
+def __masked_segment_of(segment_file):
+    # filter output next to segment_file, unique per process and thread, so that concurrent addplots never share it
+    return '%s.masked-%d-%d' % (segment_file, os.getpid(), threading.get_ident())
+
 def multi_filter(options):
     if not 'multi_filter_option' in options:
         raise Exception("multi_filter_option is required for multi_filter")
@@ -411,15 +986,21 @@ def multi_filter(options):
     if not 'sampling_rate' in options:
         raise Exception('sample_rate is required')
 
-    cmd = '/usr/local/bin/filter'
+    if 'multi_filter_in_process' in options and options['multi_filter_in_process'] == True:
+        with profiling.stage('filter', inputs=[options['base_segment']], outputs=[options['base_segment']]):
+            band_filter.filter_file(options['base_segment'], options['multi_filter_option'], options['sampling_rate'], options['window_length'])
+        return
+
+    cmd = FILTER_CMD
     option_str = f"-f {options['multi_filter_option']} --sr {options['sampling_rate']}"
-    rv = subprocess.run(f"{cmd} {option_str} {options['base_segment']} > {options['working_dir']}/masked_segment.csv", shell=True)
-    if rv.returncode != 0:
-        print(f"{cmd} command failed.", file=sys.stderr)
-        sys.exit(1)
+    masked_segment = __masked_segment_of(options['base_segment'])
+    returncode = profiling.run('filter', f"{cmd} {option_str} {options['base_segment']} > {masked_segment}", inputs=[options['base_segment']], outputs=[masked_segment])
+    if returncode != 0:
+        if os.path.exists(masked_segment):
+            os.remove(masked_segment)
+        __fail(f"{cmd} command failed.")
     else:
-        os.remove(options['base_segment'])
-        os.rename(f"{options['working_dir']}/masked_segment.csv", options['base_segment'])
+        os.replace(masked_segment, options['base_segment'])
 
 def multi_filter_add(options):
     if not 'multi_filter_option' in options:
@@ -437,12 +1018,18 @@ def multi_filter_add(options):
     if not 'sampling_rate' in options:
         raise Exception('sample_rate is required')
 
-    cmd = '/usr/local/bin/filter'
+    if 'multi_filter_in_process' in options and options['multi_filter_in_process'] == True:
+        with profiling.stage('filter', inputs=[options['add_segment']], outputs=[options['add_segment']]):
+            band_filter.filter_file(options['add_segment'], options['multi_filter_option'], options['sampling_rate'], options['window_length'])
+        return
+
+    cmd = FILTER_CMD
     option_str = f"-f {options['multi_filter_option']} --sr {options['sampling_rate']}"
-    rv = subprocess.run(f"{cmd} {option_str} {options['add_segment']} > {options['working_dir']}/masked_segment.csv", shell=True)
-    if rv.returncode != 0:
-        print(f"{cmd} command failed.", file=sys.stderr)
-        sys.exit(1)
+    masked_segment = __masked_segment_of(options['add_segment'])
+    returncode = profiling.run('filter', f"{cmd} {option_str} {options['add_segment']} > {masked_segment}", inputs=[options['add_segment']], outputs=[masked_segment])
+    if returncode != 0:
+        if os.path.exists(masked_segment):
+            os.remove(masked_segment)
+        __fail(f"{cmd} command failed.")
     else:
-        os.remove(options['add_segment'])
-        os.rename(f"{options['working_dir']}/masked_segment.csv", options['add_segment'])
+        os.replace(masked_segment, options['add_segment'])
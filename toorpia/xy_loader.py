@@ -0,0 +1,48 @@
+import os
+import threading
+import numpy
+
+# loader for coordinate files written by toorpia (base_xy / add_xy: whitespace separated "x y" per line).
+# the parsed coordinates are cached in a float32 .npy sidecar next to the text file,
+# which is memory-mapped on later loads instead of parsing the text again.
+
+SIDECAR_SUFFIX = '.npy'
+
+def sidecar_path(xy_file):
+    return xy_file + SIDECAR_SUFFIX
+
+def parse_xy(xy_file):
+    if os.path.getsize(xy_file) == 0:
+        return numpy.empty((0, 2), dtype=numpy.float32)
+    return numpy.loadtxt(xy_file, dtype=numpy.float32, usecols=(0, 1), ndmin=2)
+
+def sidecar_is_fresh(xy_file, sidecar):
+    # the sidecar carries the mtime of the text file it was made from
+    try:
+        return os.stat(sidecar).st_mtime_ns == os.stat(xy_file).st_mtime_ns
+    except FileNotFoundError:
+        return False
+
+def write_sidecar(xy_file, xy):
+    sidecar = sidecar_path(xy_file)
+    st = os.stat(xy_file)
+    try:
+        tmp = '%s.tmp-%d-%d' % (sidecar, os.getpid(), threading.get_ident())
+        with open(tmp, 'wb') as f:
+            numpy.save(f, numpy.ascontiguousarray(xy, dtype=numpy.float32))
+        os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))
+        os.replace(tmp, sidecar)
+    except OSError: # the sidecar is only an accelerator. e.g. read-only working_dir
+        return None
+    return sidecar
+
+def load_xy(xy_file, sidecar=True, mmap=True):
+    # return x and y as writable float32 arrays, whether they were parsed or read from the sidecar.
+    # a fresh sidecar is memory-mapped copy-on-write: pages are read when they are used, and writes stay in memory
+    if sidecar and sidecar_is_fresh(xy_file, sidecar_path(xy_file)):
+        xy = numpy.load(sidecar_path(xy_file), mmap_mode='c' if mmap else None)
+    else:
+        xy = parse_xy(xy_file)
+        if sidecar:
+            write_sidecar(xy_file, xy)
+    return xy[:, 0], xy[:, 1]